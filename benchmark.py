@@ -0,0 +1,388 @@
+"""Offline benchmark for the bot's hot paths.
+
+Drives the command callbacks from main.py against synthetic guilds through stand-ins for
+commands.Context, guilds and members, so no Discord connection is needed. Every run works in a
+temporary directory seeded with the bundled clues.txt and prints a JSON report, e.g.
+
+    python benchmark.py --users 200 --crosses 5 --storage sqlite --output before.json
+
+With --shard-count and --processes, a fake gateway assigns the guilds to shards and each worker
+process benchmarks only the guilds of its shard range, over the same storage.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+from board import cell_bit
+from generator import generate_cells
+from odds import numpy_available
+from rendering import IMAGE_FORMATS, IMAGE_QUALITIES, IMAGE_SIZES, ImageOutput, RenderPool
+from sharding import FakeGateway, split_shards
+from state import GuildStateCache
+from storage import FileStorage, SQLiteStorage
+
+# Audit events that touch the filesystem
+FILESYSTEM_EVENTS = {"open", "os.remove", "os.rename", "os.replace", "os.mkdir", "os.listdir", "os.scandir",
+                     "shutil.copyfile", "sqlite3.connect"}
+
+# Sheets generated back to back for the sheets_generated_per_second figure
+GENERATED_SHEETS = 5000
+
+
+class FilesystemCounter:
+    """Counts filesystem operations through an audit hook while enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.count = 0
+        sys.addaudithook(self.hook)
+
+    def hook(self, event, args):
+        if self.enabled and event in FILESYSTEM_EVENTS:
+            self.count += 1
+
+
+class FakePermissions:
+    def __init__(self, administrator=False):
+        self.administrator = administrator
+
+
+class FakeMember:
+    def __init__(self, user_id, administrator=False):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self.roles = []
+        self.guild_permissions = FakePermissions(administrator)
+
+
+class FakeGuild:
+    def __init__(self, guild_id, members, shard_id=0):
+        self.id = guild_id
+        self.shard_id = shard_id
+        self.chunked = True
+        self.members = members
+        self.members_by_id = {member.id: member for member in members}
+
+    def get_member(self, user_id):
+        return self.members_by_id.get(user_id)
+
+
+class FakeChannel:
+    """Collects what the bot sends instead of uploading it."""
+
+    def __init__(self):
+        self.id = 1
+        self.messages = 0
+        self.edits = 0
+        self.bytes_uploaded = 0
+
+    def upload(self, attachments):
+        for attachment in attachments:
+            self.bytes_uploaded += attachment.fp.getbuffer().nbytes
+
+    async def send(self, content=None, file=None, files=None, **kwargs):
+        self.messages += 1
+        self.upload(([file] if file else []) + list(files or []))
+        return FakeMessage(self)
+
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, content=None, attachments=(), **kwargs):
+        self.channel.edits += 1
+        self.channel.upload(attachments)
+        return self
+
+
+class FakeContext:
+    def __init__(self, guild, author, channel):
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+
+    async def send(self, *args, **kwargs):
+        await self.channel.send(*args, **kwargs)
+
+
+class CountingRenderPool(RenderPool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.renders = 0
+        self.render_seconds = 0.0
+        self.image_bytes = 0
+
+    async def render(self, sheet, output=ImageOutput()):
+        start = time.perf_counter()
+        image_data, extension = await super().render(sheet, output)
+        self.render_seconds += time.perf_counter() - start
+        self.renders += 1
+        self.image_bytes += len(image_data)
+        return image_data, extension
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Benchmark:
+    def __init__(self, channel, filesystem):
+        self.channel = channel
+        self.filesystem = filesystem
+        self.results = {}
+        self.shards = {}
+
+    async def run(self, name, command, guild, author, *args, **kwargs):
+        """Time one command invocation and charge its filesystem operations and uploads to name."""
+        ctx = FakeContext(guild, author, self.channel)
+        result = self.results.setdefault(name, {"latencies": [], "filesystem_ops": 0, "bytes_uploaded": 0})
+        fs_before, bytes_before = self.filesystem.count, self.channel.bytes_uploaded
+        self.filesystem.enabled = True
+        start = time.perf_counter()
+        try:
+            await command.callback(ctx, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.filesystem.enabled = False
+        result["latencies"].append(elapsed)
+        result["filesystem_ops"] += self.filesystem.count - fs_before
+        result["bytes_uploaded"] += self.channel.bytes_uploaded - bytes_before
+        self.shards.setdefault(guild.shard_id, {"guilds": set(), "latencies": []})
+        self.shards[guild.shard_id]["guilds"].add(guild.id)
+        self.shards[guild.shard_id]["latencies"].append(elapsed)
+
+    async def flush(self):
+        """Write pending guild state back to storage, charged to its own 'flush' entry."""
+        result = self.results.setdefault("flush", {"latencies": [], "filesystem_ops": 0, "bytes_uploaded": 0})
+        fs_before = self.filesystem.count
+        self.filesystem.enabled = True
+        start = time.perf_counter()
+        await main.storage.flush_async()
+        result["latencies"].append(time.perf_counter() - start)
+        self.filesystem.enabled = False
+        result["filesystem_ops"] += self.filesystem.count - fs_before
+
+    async def drain(self):
+        """Wait for debounced sheet renders, charged to their own 'debounced_render' entry."""
+        result = self.results.setdefault("debounced_render", {"latencies": [], "filesystem_ops": 0, "bytes_uploaded": 0})
+        fs_before, bytes_before = self.filesystem.count, self.channel.bytes_uploaded
+        self.filesystem.enabled = True
+        start = time.perf_counter()
+        await main.render_debouncer.drain()
+        result["latencies"].append(time.perf_counter() - start)
+        self.filesystem.enabled = False
+        result["filesystem_ops"] += self.filesystem.count - fs_before
+        result["bytes_uploaded"] += self.channel.bytes_uploaded - bytes_before
+
+    def report(self):
+        report = {}
+        for name, result in self.results.items():
+            latencies = result["latencies"]
+            report[name] = {
+                "calls": len(latencies),
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "mean_ms": sum(latencies) / len(latencies) * 1000,
+                "filesystem_ops_per_call": result["filesystem_ops"] / len(latencies),
+                "bytes_uploaded_per_call": result["bytes_uploaded"] / len(latencies),
+            }
+        return report
+
+    def shard_report(self):
+        return {
+            str(shard_id): {
+                "guilds": len(shard["guilds"]),
+                "commands": len(shard["latencies"]),
+                "p50_ms": percentile(shard["latencies"], 0.50) * 1000,
+                "p99_ms": percentile(shard["latencies"], 0.99) * 1000,
+            }
+            for shard_id, shard in sorted(self.shards.items())
+        }
+
+
+def synthetic_guild_ids(count):
+    """Guild IDs spread over shards the way Discord snowflakes are (the shard comes from the bits above 22)."""
+    return [(1000 + i) << 22 for i in range(count)]
+
+
+async def run_guild(bench, guild_id, shard_id, args):
+    members = [FakeMember(1000 + i) for i in range(args.users)]
+    admin = FakeMember(1, administrator=True)
+    guild = FakeGuild(guild_id, members + [admin], shard_id)
+    settings = main.load_settings(guild_id)
+    settings.update(image_size=args.image_size, image_format=args.image_format, image_quality=args.image_quality,
+                    balanced_sheets=args.balanced_sheets)
+    main.save_settings(guild_id, settings)
+
+    for member in members:
+        await bench.run("createBingoSheet", main.create_bingo_sheet, guild, member)
+    await bench.flush()
+
+    for member in members:
+        squares = random.sample([f"{column}{row}" for column in "ABCDE" for row in range(1, 6)], args.crosses)
+        if args.batch_crosses:
+            await bench.run("cross", main.cross_off_square, guild, member, [main.parse_squares(square) for square in squares])
+        else:
+            for square in squares:
+                await bench.run("cross", main.cross_off_square, guild, member, [main.parse_squares(square)])
+    await bench.drain()
+    await bench.flush()
+
+    for member in members:
+        board = main.load_board(guild.id, member.id)
+        crossed = sorted(board.crossed_cells())
+        if crossed:
+            cell = crossed[0]
+            await bench.run("uncross", main.uncross_square, guild, member, [cell_bit(cell)])
+    await bench.drain()
+    await bench.flush()
+
+    for member in members:
+        await bench.run("viewBingoSheet", main.view_bingo_sheet, guild, member)
+
+    for _ in range(args.list_calls):
+        await bench.run("listMaroClues", main.list_maro_clues, guild, admin)
+
+    # The first call simulates, the rest are served from the cache until the next cross
+    if numpy_available():
+        for _ in range(args.odds_calls):
+            await bench.run("odds", main.odds, guild, admin)
+    await bench.flush()
+
+
+async def run_benchmark(args, filesystem, guild_ids):
+    random.seed(args.seed)
+    gateway = FakeGateway(args.shard_count, guild_ids)
+    channel = FakeChannel()
+    bench = Benchmark(channel, filesystem)
+
+    started = time.perf_counter()
+    for guild_id in guild_ids:
+        await run_guild(bench, guild_id, gateway.shard_of(guild_id), args)
+    elapsed = time.perf_counter() - started
+
+    # Sheets are regenerated from their seed whenever they are loaded, so time generation on its own too
+    generation_seconds = 0.0
+    if guild_ids:
+        clues = main.load_clues(guild_ids[0])[1]
+        layout = main.sheet_layout(main.load_settings(guild_ids[0]))
+        generation_started = time.perf_counter()
+        for seed in range(GENERATED_SHEETS):
+            generate_cells(clues, seed, layout)
+        generation_seconds = time.perf_counter() - generation_started
+
+    pool = main.render_pool
+    return {
+        "config": {
+            "guilds": len(guild_ids),
+            "users_per_guild": args.users,
+            "crosses_per_user": args.crosses,
+            "batch_crosses": args.batch_crosses,
+            "storage": args.storage,
+            "render_backend": args.render_backend,
+            "render_workers": pool.workers,
+            "render_debounce": main.render_debouncer.delay,
+            "image_output": [args.image_size, args.image_format, args.image_quality],
+            "balanced_sheets": args.balanced_sheets,
+            "seed": args.seed,
+        },
+        "commands": bench.report(),
+        "shards": bench.shard_report(),
+        "renders": pool.renders,
+        "renders_per_second": pool.renders / pool.render_seconds if pool.render_seconds else 0.0,
+        "bytes_per_image": pool.image_bytes / pool.renders if pool.renders else 0.0,
+        "sheets_generated_per_second": GENERATED_SHEETS / generation_seconds if generation_seconds else 0.0,
+        "messages_sent": channel.messages,
+        "messages_edited": channel.edits,
+        "bytes_uploaded": channel.bytes_uploaded,
+        "total_seconds": elapsed,
+    }
+
+
+def run_process(args, work_dir, guild_ids):
+    """Benchmark guild_ids in work_dir with fresh storage and render pool; runs in the parent or a shard worker."""
+    os.chdir(work_dir)
+    backend = SQLiteStorage("bingo.db") if args.storage == 'sqlite' else FileStorage()
+    main.storage = GuildStateCache(backend)
+    main.render_pool = CountingRenderPool(args.render_backend, args.render_workers)
+    main.render_debouncer.delay = args.render_debounce
+    filesystem = FilesystemCounter()
+    try:
+        return asyncio.run(run_benchmark(args, filesystem, guild_ids))
+    finally:
+        main.render_pool.shutdown()
+        main.storage.close()
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's commands against synthetic guilds.")
+    parser.add_argument('--users', type=int, default=100, help='number of members with a sheet in each guild')
+    parser.add_argument('--crosses', type=int, default=5, help='squares each member crosses off')
+    parser.add_argument('--batch-crosses', action='store_true', help='cross them all off with one /cross command')
+    parser.add_argument('--list-calls', type=int, default=20, help='number of /listMaroClues calls per guild')
+    parser.add_argument('--odds-calls', type=int, default=5, help='number of /odds calls per guild (needs NumPy)')
+    parser.add_argument('--guilds', type=int, default=1, help='number of synthetic guilds')
+    parser.add_argument('--shard-count', type=int, default=1, help='shards the fake gateway spreads guilds over')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='run shard ranges in this many worker processes over shared storage')
+    parser.add_argument('--storage', choices=['files', 'sqlite'], default='files')
+    parser.add_argument('--render-backend', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--render-workers', type=int, default=None)
+    parser.add_argument('--image-size', choices=list(IMAGE_SIZES), default=ImageOutput().size)
+    parser.add_argument('--image-format', choices=IMAGE_FORMATS, default=ImageOutput().format)
+    parser.add_argument('--image-quality', choices=IMAGE_QUALITIES, default=ImageOutput().quality)
+    parser.add_argument('--render-debounce', type=float, default=0.0,
+                        help="seconds the bot's render debouncer waits after /cross and /uncross (0 renders every change)")
+    parser.add_argument('--balanced-sheets', action='store_true', help='turn on /balancedSheets for the guilds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    clues_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clues.txt")
+    output = os.path.abspath(args.output) if args.output else None
+    work_dir = tempfile.mkdtemp(prefix="bingo-bench-")
+    previous_dir = os.getcwd()
+    shutil.copyfile(clues_file, os.path.join(work_dir, "clues.txt"))
+    gateway = FakeGateway(args.shard_count, synthetic_guild_ids(args.guilds))
+    try:
+        if args.processes > 1:
+            # Each worker owns the guilds of its shard range, like the bot's --processes launcher
+            # Not a multiprocessing.Pool: its workers are daemons, which can't start a process render pool
+            # Shard ranges that own no guilds get no worker
+            shard_ranges = split_shards(args.shard_count, args.processes)
+            assignment = {i: guild_ids for i, guild_ids in gateway.assignment(args.processes).items() if guild_ids}
+            workers = len(assignment)
+            with ProcessPoolExecutor(workers or 1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                reports = list(pool.map(run_process, [args] * workers, [work_dir] * workers, assignment.values()))
+            report = {"processes": [{"shard_ids": shard_ranges[i], **worker_report}
+                                    for i, worker_report in zip(assignment, reports)]}
+        else:
+            report = run_process(args, work_dir, gateway.guild_ids)
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main_benchmark()
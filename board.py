@@ -0,0 +1,116 @@
+SIZE = 5  # Bingo board is always 5x5
+CELLS = SIZE * SIZE
+FULL_MASK = (1 << CELLS) - 1
+COLUMN_LETTERS = "ABCDE"
+
+FREE_SPACE = "Free"  # Clue text of the middle cell when free space is on
+FREE_CELL = -1  # Stored in place of a clue set index for the free space
+
+
+def cell_bit(clue_index):
+    return 1 << clue_index
+
+
+def line_mask(cells):
+    mask = 0
+    for cell in cells:
+        mask |= cell_bit(cell)
+    return mask
+
+
+# The 12 winning lines as (name, mask): 5 rows, 5 columns and 2 diagonals
+WIN_LINES = tuple(
+    [(f"row {row + 1}", line_mask(row * SIZE + col for col in range(SIZE))) for row in range(SIZE)] +
+    [(f"column {COLUMN_LETTERS[col]}", line_mask(row * SIZE + col for row in range(SIZE))) for col in range(SIZE)] +
+    [("diagonal A1-E5", line_mask(i * SIZE + i for i in range(SIZE))),
+     ("diagonal E1-A5", line_mask(i * SIZE + SIZE - i - 1 for i in range(SIZE)))]
+)
+WIN_MASKS = tuple(mask for _, mask in WIN_LINES)
+
+
+def rectangle_mask(first, last):
+    """Mask of every cell in the rectangle with corners at cell indices first and last, e.g. a row or column."""
+    (first_row, first_col), (last_row, last_col) = divmod(first, SIZE), divmod(last, SIZE)
+    return line_mask(row * SIZE + col
+                     for row in range(min(first_row, last_row), max(first_row, last_row) + 1)
+                     for col in range(min(first_col, last_col), max(first_col, last_col) + 1))
+
+
+def square_name(clue_index):
+    """Name of a cell as typed in commands, e.g. 7 -> 'C2'."""
+    row, col = divmod(clue_index, SIZE)
+    return f"{COLUMN_LETTERS[col]}{row + 1}"
+
+
+class Board:
+    """A bingo sheet: the expansion it belongs to, its 25 clue texts and a bitmask of crossed cells.
+
+    Bit i of crossed is set when the cell at index i (row by row, A1 = 0, E5 = 24) is crossed off.
+    clue_set is the ID of the stored clue set the clues were drawn from, once storage has saved the sheet.
+    seed and layout are set for generated sheets, which storage keeps as just those and the clue set.
+    """
+
+    __slots__ = ("expansion", "clues", "crossed", "clue_set", "seed", "layout")
+
+    def __init__(self, expansion, clues, crossed=0, clue_set=None, seed=None, layout=0):
+        self.expansion = expansion
+        self.clues = list(clues)
+        self.crossed = crossed
+        self.clue_set = clue_set
+        self.seed = seed
+        self.layout = layout
+
+    def copy(self):
+        return Board(self.expansion, self.clues, self.crossed, self.clue_set, self.seed, self.layout)
+
+    def is_crossed(self, clue_index):
+        return bool(self.crossed & cell_bit(clue_index))
+
+    def cross(self, clue_index):
+        self.crossed |= cell_bit(clue_index)
+
+    def uncross(self, clue_index):
+        self.crossed &= ~cell_bit(clue_index)
+
+    def crossed_cells(self):
+        return frozenset(i for i in range(CELLS) if self.crossed & cell_bit(i))
+
+    def has_bingo(self):
+        return any(self.crossed & mask == mask for mask in WIN_MASKS)
+
+    def cells_from_bingo(self):
+        """Fewest cells that still have to be crossed to complete any line (0 means bingo)."""
+        return min(bin(mask & ~self.crossed).count("1") for mask in WIN_MASKS)
+
+    def open_lines(self):
+        """Lines that are not complete yet, as (name, cells missing) pairs."""
+        return [(name, bin(mask & ~self.crossed).count("1")) for name, mask in WIN_LINES
+                if self.crossed & mask != mask]
+
+    def clue_set_cells(self, positions):
+        """The clue set index of every cell given {clue: index} for the set, with FREE_CELL for the free space."""
+        return [FREE_CELL if clue == FREE_SPACE and clue not in positions else positions[clue] for clue in self.clues]
+
+    @classmethod
+    def from_clue_set(cls, clue_set, cells, crossed=0, seed=None, layout=0):
+        """Build a board from a clue set and the index of each cell's clue in it."""
+        clues = [FREE_SPACE if cell == FREE_CELL else clue_set.clues[cell] for cell in cells]
+        return cls(clue_set.expansion, clues, crossed, clue_set.id, seed, layout)
+
+    def to_dict(self):
+        return {"expansion": self.expansion, "clues": self.clues, "crossed": self.crossed}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["expansion"], data["clues"], data.get("crossed", 0))
+
+    @classmethod
+    def from_legacy(cls, expansion, clues):
+        """Build a board from the old sheet format, where crossed clues end with ' X'."""
+        board = cls(expansion, [])
+        for i, clue in enumerate(clues):
+            if clue.endswith(" X"):
+                clue = clue[:-2]
+                board.cross(i)
+            board.clues.append(clue)
+        return board
@@ -0,0 +1,45 @@
+import asyncio
+import traceback
+
+from metrics import metrics
+
+
+class Debouncer:
+    """Runs a coroutine function once per key, after calls for that key have stopped for delay seconds.
+
+    A call that arrives while an earlier one for the same key is still waiting replaces it, so a burst
+    of /cross commands renders the sheet once, in its final state. With a delay of 0 calls run right away.
+    """
+
+    def __init__(self, delay=2.0):
+        self.delay = delay
+        self.waiting = {}  # key -> task sleeping before its call
+        self.running = set()
+        self.coalesced = 0
+
+    async def call(self, key, func):
+        if self.delay <= 0:
+            await func()
+            return
+        task = self.waiting.get(key)
+        if task is not None:
+            # Tasks leave waiting before they call func, so this only ever cancels a sleep
+            task.cancel()
+            self.coalesced += 1
+            metrics.increment("bingo_debounced_calls_total")
+        task = self.waiting[key] = asyncio.create_task(self.run_later(key, func))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def run_later(self, key, func):
+        await asyncio.sleep(self.delay)
+        del self.waiting[key]
+        try:
+            await func()
+        except Exception:
+            traceback.print_exc()
+
+    async def drain(self):
+        """Wait until every waiting and running call has finished."""
+        while self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
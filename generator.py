@@ -0,0 +1,138 @@
+import hashlib
+import random
+import re
+from functools import lru_cache
+
+from board import CELLS, FREE_CELL, SIZE
+
+# Layout flags stored with a sheet's seed. Sheets are regenerated from (clue set, seed, layout), so what
+# generate_cells does for a given layout must never change; new behavior needs a new flag.
+LAYOUT_FREE_SPACE = 1
+LAYOUT_BALANCED = 2
+# Draws with HashRandom instead of random.Random, whose sample() and shuffle() results Python doesn't
+# promise to keep. Every new sheet sets it; older seeded sheets still decode with random.Random.
+LAYOUT_HASHED = 4
+
+CENTER = CELLS // 2
+
+# Checked in order; a clue gets the first category whose pattern it matches
+CATEGORY_PATTERNS = (
+    ("token", re.compile(r"\btoken$", re.IGNORECASE)),
+    ("counter", re.compile(r"\bcounter$", re.IGNORECASE)),
+    ("creature type", re.compile(r"\bcreature [–—-]|^\d+ \w+ cards$", re.IGNORECASE)),
+    ("rules text", re.compile(r"^[“\"]")),
+    ("card name", re.compile(r"^[A-Z][\w'’-]*( [A-Z][\w'’-]*){0,3}$")),
+)
+
+# Cell for each position of the balanced order: each run of five positions starting at a multiple of
+# five is a diagonal, and any five consecutive positions cover every row, so a category placed in
+# consecutive positions is spread over rows and columns.
+BALANCED_ORDER = tuple((k % SIZE) * SIZE + (k % SIZE + k // SIZE) % SIZE for k in range(CELLS))
+
+
+class HashRandom:
+    """Random choices from a seed that come out the same on every Python version and platform.
+
+    Draws are 64-bit words of BLAKE2b(seed, block number) digests, turned into integers by rejection
+    sampling, and sample() and shuffle() are plain Fisher-Yates over them. Sheets stored as only a seed
+    depend on all of this staying exactly as it is.
+    """
+
+    def __init__(self, seed):
+        self.key = seed.to_bytes(8, "little", signed=True)
+        self.block = 0
+        self.words = []
+
+    def word(self):
+        if not self.words:
+            digest = hashlib.blake2b(self.block.to_bytes(8, "little"), key=self.key, digest_size=64).digest()
+            self.words = [int.from_bytes(digest[i:i + 8], "little") for i in range(56, -8, -8)]
+            self.block += 1
+        return self.words.pop()
+
+    def randbelow(self, n):
+        if n <= 0:
+            raise ValueError(f"randbelow needs a positive bound, not {n}")
+        bits = n.bit_length()
+        while True:
+            value = self.word() >> (64 - bits)
+            if value < n:
+                return value
+
+    def random(self):
+        return (self.word() >> 11) / (1 << 53)
+
+    def shuffle(self, items):
+        for i in range(len(items) - 1, 0, -1):
+            j = self.randbelow(i + 1)
+            items[i], items[j] = items[j], items[i]
+
+    def sample(self, population, k):
+        pool = list(population)
+        for i in range(k):
+            j = i + self.randbelow(len(pool) - i)
+            pool[i], pool[j] = pool[j], pool[i]
+        return pool[:k]
+
+
+def new_seed():
+    return random.getrandbits(63)  # Fits a signed 64-bit SQLite integer
+
+
+def clue_category(clue):
+    for category, pattern in CATEGORY_PATTERNS:
+        if pattern.search(clue):
+            return category
+    return "other"
+
+
+@lru_cache(maxsize=64)
+def category_indices(clues):
+    """Clue indices grouped by category, for a tuple of clues."""
+    groups = {}
+    for i, clue in enumerate(clues):
+        groups.setdefault(clue_category(clue), []).append(i)
+    return tuple(tuple(indices) for _, indices in sorted(groups.items()))
+
+
+def category_quotas(groups, count):
+    """How many clues to take from each category so a sheet mirrors the clue set (largest remainder method)."""
+    total = sum(len(group) for group in groups)
+    shares = [len(group) * count / total for group in groups]
+    quotas = [int(share) for share in shares]
+    by_remainder = sorted(range(len(groups)), key=lambda i: shares[i] - quotas[i], reverse=True)
+    for i in by_remainder[:count - sum(quotas)]:
+        quotas[i] += 1
+    return quotas
+
+
+def generate_cells(clues, seed, layout=0):
+    """The clue index of each of the 25 cells of the sheet for seed, with FREE_CELL for the free space.
+
+    With LAYOUT_BALANCED the categories appear in the same proportions as in the clue set and each one
+    is spread over the rows and columns; otherwise the clues are a plain random sample.
+    """
+    if len(clues) < CELLS:
+        raise ValueError(f"A sheet needs at least {CELLS} clues, got {len(clues)}")
+    rng = HashRandom(seed) if layout & LAYOUT_HASHED else random.Random(seed)
+    if layout & LAYOUT_BALANCED:
+        groups = category_indices(tuple(clues))
+        picked = [rng.sample(group, quota) for group, quota in zip(groups, category_quotas(groups, CELLS))]
+        rng.shuffle(picked)
+        ordered = [index for group in picked for index in group]
+
+        # Permuting rows and columns (and transposing) keeps every category spread out
+        rows = rng.sample(range(SIZE), SIZE)
+        columns = rng.sample(range(SIZE), SIZE)
+        transpose = rng.random() < 0.5
+        cells = [0] * CELLS
+        for index, cell in zip(ordered, BALANCED_ORDER):
+            row, column = divmod(cell, SIZE)
+            if transpose:
+                row, column = column, row
+            cells[rows[row] * SIZE + columns[column]] = index
+    else:
+        cells = rng.sample(range(len(clues)), CELLS)
+    if layout & LAYOUT_FREE_SPACE:
+        cells[CENTER] = FREE_CELL
+    return cells
@@ -0,0 +1,58 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from metrics import metrics
+
+
+class LockManager:
+    """Hands out asyncio locks by key, creating them on first use and dropping them once nobody holds or waits.
+
+    Sheet edits lock ("user", guild_id, user_id) so different users never wait on each other; settings
+    updates take a short ("guild", guild_id) lock. Code that needs both takes the user lock first.
+    """
+
+    def __init__(self):
+        self.locks = {}  # key -> [lock, number of holders and waiters]
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @asynccontextmanager
+    async def lock(self, *key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            lock = entry[0]
+            if lock.locked():
+                self.contended += 1
+            start = time.perf_counter()
+            async with lock:
+                waited = time.perf_counter() - start
+                self.acquisitions += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                metrics.observe("bingo_lock_wait_seconds", waited, scope=key[0])
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    def user(self, guild_id, user_id):
+        return self.lock("user", guild_id, user_id)
+
+    def guild(self, guild_id):
+        return self.lock("guild", guild_id)
+
+    def stats(self):
+        return {
+            "active_locks": len(self.locks),
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "wait_seconds": self.wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
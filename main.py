@@ -1,121 +1,418 @@
 import argparse
+import io
+import json
+import math
 import os
 import re
-import shutil
+import sys
+import time
+import traceback
+import zipfile
+from collections import OrderedDict
 
 import discord
 import asyncio
-import json
-from PIL import Image, ImageDraw, ImageFont
-from random import sample
-from discord.ext import commands
+from discord.ext import commands, tasks
+from typing import Optional, Union
+
+from board import FREE_CELL, FREE_SPACE, Board, cell_bit, rectangle_mask, square_name
+from debounce import Debouncer
+from generator import LAYOUT_BALANCED, LAYOUT_FREE_SPACE, LAYOUT_HASHED, generate_cells, new_seed
+from locks import LockManager
+from metrics import metrics
+from odds import bingo_odds, numpy_available
+from rendering import (CONTACT_SHEET_TILES, IMAGE_FORMATS, IMAGE_QUALITIES, IMAGE_SIZES, ImageOutput, RenderPool, SheetSpec,
+                       render_contact_sheet)
+from sharding import launch_shard_processes, parse_shard_ids
+from state import GuildStateCache
+from storage import DEFAULT_CLUES_FILE, FileStorage, SQLiteStorage, atomic_write, import_directory_tree, read_sheet
 
 # Define intents and create bot with command prefix
 intents = discord.Intents.default()
 intents.message_content = True
+intents.members = True  # Needed to list the members of a role or guild in /createBingoSheets
+
+# Bytes a zip archive adds per entry (local header and central directory record, plus its name) and once at the end
+ZIP_ENTRY_BYTES = 30 + 46
+ZIP_END_BYTES = 22
+
+# /listMaroClues shows at most this many clues per page, and pages always fit in one message
+CLUES_PER_PAGE = 25
+MESSAGE_LIMIT = 2000
+
+# Sharded so large deployments can spread guilds over shards and processes; main() sets the shard layout.
+# Member lists are fetched when /createBingoSheets needs them instead of for every guild at startup.
+bot = commands.AutoShardedBot(command_prefix='/', intents=intents, case_insensitive=True,
+                              chunk_guilds_at_startup=False)
+
+# For the startup time gauge; module import is where the process starts doing real work
+process_started = time.perf_counter()
+
+# Per-user locks guard sheet edits and per-guild locks guard settings updates
+locks = LockManager()
+
+# Sheet images are drawn here instead of on the event loop; main() may replace it with a configured pool
+render_pool = RenderPool()
+
+# Guild settings, clues and sheets are served from memory and written back to the backend in the background;
+# main() may replace it with one around the configured backend
+storage = GuildStateCache(FileStorage())
+
+# Coalesces the sheet re-renders after /cross and /uncross per user; main() sets the delay
+render_debouncer = Debouncer()
+
+# Sheets the bot posted recently, as (guild_id, user_id) -> (message, monotonic time posted), oldest first.
+# Re-renders edit these in place while they are younger than sheet_edit_window seconds.
+sheet_messages = OrderedDict()
+sheet_edit_window = 300.0
+
+def ensure_guild(guild_id):
+    storage.ensure_guild(guild_id)
+
+def load_settings(guild_id):
+    with metrics.timed("bingo_phase_seconds", phase="settings_load"):
+        return storage.load_settings(guild_id)
+
+def save_settings(guild_id, settings):
+    with metrics.timed("bingo_phase_seconds", phase="save"):
+        storage.save_settings(guild_id, settings)
+
+def load_clues(guild_id):
+    return storage.load_clues(guild_id)
+
+def save_clues(guild_id, expansion, clues):
+    with metrics.timed("bingo_phase_seconds", phase="save"):
+        storage.save_clues(guild_id, expansion, clues)
+
+def load_board(guild_id, user_id):
+    with metrics.timed("bingo_phase_seconds", phase="sheet_parse"):
+        return storage.load_board(guild_id, user_id)
+
+def load_boards(guild_id, user_ids):
+    with metrics.timed("bingo_phase_seconds", phase="sheet_parse"):
+        return storage.load_boards(guild_id, user_ids)
+
+def save_board(guild_id, user_id, board):
+    with metrics.timed("bingo_phase_seconds", phase="save"):
+        storage.save_board(guild_id, user_id, board)
+
+def save_boards(guild_id, boards):
+    with metrics.timed("bingo_phase_seconds", phase="save"):
+        storage.save_boards(guild_id, boards)
+
+def update_crossed(guild_id, user_id, cross=0, uncross=0):
+    with metrics.timed("bingo_phase_seconds", phase="save"):
+        return storage.update_crossed(guild_id, user_id, cross, uncross)
+
+# guild_id -> {reveals: {user_id: chance}} from /odds, until record_progress sees the next cross or reveal
+odds_cache = {}
+
+def record_progress(guild_id, boards):
+    """Update the leaderboard and bingo order from changed sheets and return the users with a new bingo.
+
+    For every {user_id: Board} this stores the user's cells from bingo and whether their bingo has been
+    announced, and keeps settings["bingo_order"] in the order users first got bingo on a sheet for the current
+    expansion. Hold the guild lock.
+    """
+    odds_cache.pop(guild_id, None)
+    settings = load_settings(guild_id)
+    clue_set = load_clues(guild_id)
+    current_expansion = clue_set[0] if clue_set else None
+    bingo_order = settings.setdefault("bingo_order", [])
+    new_winners = []
+    for user_id, board in boards.items():
+        user_settings = settings["users"].setdefault(str(user_id), {"bingo_declared": False})
+        user_settings["expansion"] = board.expansion
+        user_settings["cells_from_bingo"] = board.cells_from_bingo()
+        if board.has_bingo():
+            if not user_settings.get("bingo_declared", False):
+                user_settings["bingo_declared"] = True
+                new_winners.append(user_id)
+        else:
+            user_settings["bingo_declared"] = False
+        # Bingo on a sheet from an earlier expansion doesn't count towards this one's order
+        if board.has_bingo() and board.expansion == current_expansion:
+            if user_id not in bingo_order:
+                bingo_order.append(user_id)
+        elif user_id in bingo_order:
+            bingo_order.remove(user_id)
+    save_settings(guild_id, settings)
+    return new_winners
+
+def backfill_progress(guild_id):
+    """Record the progress of sheets saved before record_progress kept it, once per guild. Hold the guild lock.
+
+    /leaderboard and /odds only see players with a recorded expansion and cells from bingo.
+    """
+    settings = load_settings(guild_id)
+    if settings.get("progress_recorded"):
+        return
+    missing = [user_id for user_id in storage.user_ids(guild_id)
+               if "cells_from_bingo" not in settings["users"].get(str(user_id), {})]
+    if missing:
+        record_progress(guild_id, storage.load_boards(guild_id, missing))
+    settings = load_settings(guild_id)
+    settings["progress_recorded"] = True
+    save_settings(guild_id, settings)
+
+def find_clue(clues, query):
+    """Match query against a clue list: exact (ignoring case) first, then a unique substring. Returns (clue, candidates)."""
+    query = query.strip().lower()
+    for clue in clues:
+        if clue.lower() == query:
+            return clue, [clue]
+    candidates = [clue for clue in clues if query in clue.lower()]
+    return (candidates[0] if len(candidates) == 1 else None), candidates
+
+async def send_lines(ctx, lines, limit=2000, **kwargs):
+    """Send lines as few messages as possible while staying under Discord's message length limit."""
+    message = ""
+    for line in lines:
+        if message and len(message) + len(line) + 1 > limit:
+            await ctx.send(message, **kwargs)
+            message = ""
+        message = f"{message}\n{line}" if message else line
+    if message:
+        await ctx.send(message, **kwargs)
+
+def sheet_layout(settings):
+    """Layout flags for new sheets from the guild's /freeSpace and /balancedSheets settings."""
+    layout = LAYOUT_HASHED
+    if settings.get("free_space_enabled", False):
+        layout |= LAYOUT_FREE_SPACE
+    if settings.get("balanced_sheets", False):
+        layout |= LAYOUT_BALANCED
+    return layout
+
+def new_board(expansion, clues, layout):
+    """A sheet generated from a new seed, so storage only has to keep the seed."""
+    seed = new_seed()
+    cells = generate_cells(clues, seed, layout)
+    return Board(expansion, [FREE_SPACE if cell == FREE_CELL else clues[cell] for cell in cells], seed=seed, layout=layout)
+
+def remember_sheet_message(guild_id, user_id, message):
+    sheet_messages[(guild_id, user_id)] = (message, time.monotonic())
+    sheet_messages.move_to_end((guild_id, user_id))
+    # Entries are in posting order, so expired ones are all at the front
+    while sheet_messages:
+        _, (_, posted) = next(iter(sheet_messages.items()))
+        if time.monotonic() - posted <= sheet_edit_window:
+            break
+        sheet_messages.popitem(last=False)
+
+def recent_sheet_message(guild_id, user_id, channel):
+    """The user's last sheet message if it is in channel and still young enough to edit, else None."""
+    message, posted = sheet_messages.get((guild_id, user_id), (None, 0.0))
+    if message is None or message.channel.id != channel.id or time.monotonic() - posted > sheet_edit_window:
+        return None
+    return message
+
+# Formatted /listMaroClues pages as guild_id -> {search: pages}, most recently added search last.
+# Dropped when the guild's clues change, so listing again costs no storage access or formatting.
+clue_listings = {}
+MAX_CACHED_SEARCHES = 32
+
+def paginate_clues(expansion, clues, search=""):
+    """Split the numbered clues containing every word of search into pages that each fit in one message."""
+    words = search.lower().split()
+    lines = [f"{number}. {clue}" for number, clue in enumerate(clues, start=1)
+             if all(word in clue.lower() for word in words)]
+    title = f"**Clues for {expansion}**" + (f" matching '{search}'" if search else "")
+    budget = MESSAGE_LIMIT - len(title) - 40  # Room for the page count and code block fences
+    chunks = []
+    chunk = []
+    for line in lines:
+        line = line[:budget]
+        if chunk and (len(chunk) == CLUES_PER_PAGE or sum(len(l) + 1 for l in chunk) + len(line) > budget):
+            chunks.append(chunk)
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        chunks.append(chunk)
+    pages = []
+    for i, chunk in enumerate(chunks, start=1):
+        body = "\n".join(chunk)
+        pages.append(f"{title} (page {i}/{len(chunks)}):\n```{body}```")
+    return pages
+
+def clue_pages(guild_id, search=""):
+    listings = clue_listings.setdefault(guild_id, {})
+    pages = listings.get(search)
+    if pages is None:
+        expansion, clues = load_clues(guild_id)
+        pages = listings[search] = paginate_clues(expansion, clues, search)
+        if len(listings) > MAX_CACHED_SEARCHES:
+            del listings[next(iter(listings))]
+    return pages
+
+class CluePageView(discord.ui.View):
+    """Previous and Next buttons that page through a /listMaroClues message in place."""
+
+    def __init__(self, pages, page):
+        super().__init__(timeout=300)
+        self.pages = pages
+        self.page = page
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page == len(self.pages) - 1
+
+    async def show(self, interaction, page):
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(content=self.pages[page], view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show(interaction, max(self.page - 1, 0))
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show(interaction, min(self.page + 1, len(self.pages) - 1))
+
+def sheet_spec(board):
+    return SheetSpec(expansion=board.expansion, clues=tuple(board.clues), crossed=board.crossed_cells())
+
+# (guild_id, size, quality) -> the format "auto" picked for that guild's sheets. Sheets of one guild at one size
+# and quality compress alike, so after the first render only the winning format is encoded
+auto_formats = {}
+
+def image_output(settings, guild_id=None):
+    """The guild's image size, format and quality settings as an ImageOutput.
+
+    Given guild_id, "auto" is replaced by the format it picked for the guild's last rendered sheet.
+    """
+    defaults = ImageOutput()
+    output = ImageOutput(settings.get("image_size", defaults.size), settings.get("image_format", defaults.format),
+                         settings.get("image_quality", defaults.quality))
+    if output.format == "auto" and guild_id is not None:
+        output = output._replace(format=auto_formats.get((guild_id, output.size, output.quality), "auto"))
+    return output
+
+async def render_named(named_boards, output=ImageOutput()):
+    """Render (name, board) pairs in parallel, a batch at a time, and yield (name, image bytes, file extension) in order."""
+    batch_size = render_pool.workers * 4
+    for start in range(0, len(named_boards), batch_size):
+        batch = named_boards[start:start + batch_size]
+        images = await asyncio.gather(*(render_pool.render(sheet_spec(board), output) for _, board in batch))
+        for (name, _), (image_data, extension) in zip(batch, images):
+            yield name, image_data, extension
+
+async def render_archives(named_boards, output=ImageOutput(), part_bytes=None):
+    """Render (name, board) pairs in parallel and pack the images into zip archives of at most part_bytes each
+    (None for a single archive).
+
+    Each image is stored as the name plus the extension of the encoding the renderer picked.
+    """
+    archives = []
+    buffer = io.BytesIO()
+    archive = zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED)  # The images are already compressed
+    directory_bytes = ZIP_END_BYTES  # What closing the archive will still add
+    async for name, image_data, extension in render_named(named_boards, output):
+        filename = f"{name}.{extension}"
+        entry_bytes = ZIP_ENTRY_BYTES + 2 * len(filename.encode("utf-8")) + len(image_data)
+        if part_bytes and archive.namelist() and buffer.tell() + directory_bytes + entry_bytes > part_bytes:
+            archive.close()
+            archives.append(buffer.getvalue())
+            buffer = io.BytesIO()
+            archive = zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED)
+            directory_bytes = ZIP_END_BYTES
+        archive.writestr(filename, image_data)
+        directory_bytes += 46 + len(filename.encode("utf-8"))
+    archive.close()
+    archives.append(buffer.getvalue())
+    return archives
+
+def parse_square(square):
+    """Turn a square like 'B3' into its cell index, or None if it isn't a valid square."""
+    match = re.match(r'([A-E][1-5])', square.upper())
+    if not match:
+        return None
 
-bot = commands.Bot(command_prefix='/', intents=intents, case_insensitive=True)
-
-def read_sheet(path):
-    expansion = None
-    clues = []
-    with open(path, 'r') as infile:
-        for line in infile:
-            if line.startswith("#"):
-                expansion = line[1:].strip()
-            else:
-                clues.append(line.strip())
-    return expansion, clues
-
-def get_server_directory(guild_id):
-    return f"servers/{guild_id}"
-
-def get_settings_file(guild_id):
-    return os.path.join(get_server_directory(guild_id), "settings.json")
-
-def get_clues_file(guild_id):
-    return os.path.join(get_server_directory(guild_id), "clues.txt")
+    square_id = match.group(1)
+    column_index = ord(square_id[0]) - ord('A')
+    row_index = int(square_id[1]) - 1
+    return row_index * 5 + column_index
+
+def parse_squares(text):
+    """Turn a square (B3), a column (B), a row (3) or a range (B1-B4, or B1-C2 for a block) into a bitmask of cells.
+
+    Returns None if text is none of these.
+    """
+    text = text.upper()
+    if re.fullmatch(r'[A-E]', text):
+        return rectangle_mask(parse_square(f"{text}1"), parse_square(f"{text}5"))
+    if re.fullmatch(r'[1-5]', text):
+        return rectangle_mask(parse_square(f"A{text}"), parse_square(f"E{text}"))
+    match = re.fullmatch(r'([A-E][1-5])(?:-([A-E][1-5]))?', text)
+    if not match:
+        return None
+    return rectangle_mask(parse_square(match.group(1)), parse_square(match.group(2) or match.group(1)))
 
-def get_bingo_sheets_directory(guild_id):
-    return os.path.join(get_server_directory(guild_id), "bingo_sheets")
+class Squares(commands.Converter):
+    """Command argument converter for parse_squares, so commands.Greedy[Squares] collects squares until the first non-square."""
 
-def ensure_server_directories(guild_id):
-    server_dir = get_server_directory(guild_id)
-    bingo_sheets_dir = get_bingo_sheets_directory(guild_id)
-    clues_file = get_clues_file(guild_id)
+    async def convert(self, ctx, argument):
+        mask = parse_squares(argument)
+        if mask is None:
+            raise commands.BadArgument(f"'{argument}' is not a square, row or column.")
+        return mask
 
-    os.makedirs(server_dir, exist_ok=True)
-    os.makedirs(bingo_sheets_dir, exist_ok=True)
-    if not os.path.exists(clues_file):
-        shutil.copyfile("clues.txt", clues_file)
+@tasks.loop(seconds=30)
+async def flush_guild_state():
+    await storage.flush_async()
 
-def load_settings(settings_file):
-    try:
-        with open(settings_file, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {
-            "free_space_enabled": False,
-            "bingo_role": "Bingo Master",
-            "users": {}
-        }
-
-def save_settings(settings_file, settings):
-    os.makedirs(os.path.dirname(settings_file), exist_ok=True)
-    with open(settings_file, "w") as f:
-        json.dump(settings, f, indent=4)
-
-def check_bingo(clues):
-    size = 5  # Bingo board is always 5x5
-    board = [clues[i:i+size] for i in range(0, len(clues), size)]  # Create a 5x5 board
-
-    # Check rows for Bingo
-    for row in board:
-        if all(clue.endswith(" X") for clue in row):
-            return True
-
-    # Check columns for Bingo
-    for col in range(size):
-        if all(board[row][col].endswith(" X") for row in range(size)):
-            return True
-
-    # Check diagonals for Bingo
-    if all(board[i][i].endswith(" X") for i in range(size)) or \
-       all(board[i][size-i-1].endswith(" X") for i in range(size)):
-        return True
-
-    return False
-
-def bingo_declared(user_bingo_file):
-    bingo_marker = "# BINGO DECLARED"
-    with open(user_bingo_file, 'r') as f:
-        lines = f.readlines()
-
-    if bingo_marker in lines:
-        return True
-
-    # Append the marker and save the file
-    with open(user_bingo_file, 'a') as f:
-        f.write(f"{bingo_marker}\n")
-
-    return False
+# Where write_metrics_file puts the Prometheus text export; main() sets it from --metrics-file
+metrics_file = "metrics.prom"
 
-@bot.event
-async def on_guild_join(guild):
-    ensure_server_directories(guild.id)
+def update_shard_gauges():
+    guild_counts = {}
+    for guild in bot.guilds:
+        guild_counts[guild.shard_id] = guild_counts.get(guild.shard_id, 0) + 1
+    for shard_id, shard in bot.shards.items():
+        metrics.set_gauge("bingo_shard_latency_seconds", shard.latency, shard=shard_id)
+        metrics.set_gauge("bingo_shard_guilds", guild_counts.get(shard_id, 0), shard=shard_id)
+        metrics.set_gauge("bingo_shard_up", 0 if shard.is_closed() else 1, shard=shard_id)
+
+@tasks.loop(seconds=60)
+async def write_metrics_file():
+    update_shard_gauges()
+    with atomic_write(metrics_file) as f:
+        f.write(metrics.to_prometheus())
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.command_started = time.perf_counter()
+    # Guilds are set up on their first command rather than at startup; later calls are a dict lookup
+    if ctx.guild is not None:
+        ensure_guild(ctx.guild.id)
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    metrics.observe("bingo_command_seconds", time.perf_counter() - ctx.command_started, command=ctx.command.name)
+    metrics.increment("bingo_commands_total", command=ctx.command.name, failed=ctx.command_failed)
+    if ctx.guild is not None:
+        metrics.increment("bingo_shard_commands_total", shard=ctx.guild.shard_id)
 
 @bot.event
 async def on_ready():
-    for guild in bot.guilds:
-        ensure_server_directories(guild.id)
+    # Nothing here depends on the number of guilds, so startup takes as long for ten as for ten thousand
+    if not metrics.gauge("bingo_startup_seconds"):
+        metrics.set_gauge("bingo_startup_seconds", time.perf_counter() - process_started)
+    # Load Pillow, the fonts and the default clue layouts off the event loop
+    render_pool.warm(read_sheet(DEFAULT_CLUES_FILE)[1])
+    if not flush_guild_state.is_running():
+        flush_guild_state.start()
+    if metrics_file and not write_metrics_file.is_running():
+        write_metrics_file.start()
     print(f"Bot is ready and connected to {len(bot.guilds)} server(s).")
 
 @bot.command(name="setMaroClues", help="Set clues for the upcoming expansion.")
 async def set_maro_clues(ctx):
     guild_id = ctx.guild.id
-    ensure_server_directories(guild_id)
-    clues_file = get_clues_file(guild_id)
-    settings = load_settings(f"{guild_id}/settings.json")
+    ensure_guild(guild_id)
+    settings = load_settings(guild_id)
     bingo_role = settings["bingo_role"]
 
     # Check if the user has administrator permissions or bingo role
@@ -136,13 +433,22 @@ async def set_maro_clues(ctx):
         if not clues[0].startswith("#"):
             await ctx.send("Make sure to start with a # followed by the expansion name")
             return
-        if len(clues) < 25:
-            await ctx.send("You must provide at least 24 clues. Please try again.")
+        if len(clues) - 1 < 25:  # Not counting the expansion line
+            await ctx.send("You must provide at least 25 clues. Please try again.")
             return
 
-        with open(clues_file, 'w', encoding='utf-8') as outfile:
-            for clue in clues:
-                outfile.write(f"{clue}\n")
+        expansion = clues[0][1:].strip()
+        async with locks.guild(guild_id):
+            save_clues(guild_id, expansion, clues[1:])
+            clue_listings.pop(guild_id, None)
+            odds_cache.pop(guild_id, None)
+            settings = load_settings(guild_id)
+            settings["revealed_clues"] = []
+            settings["bingo_order"] = []
+            save_settings(guild_id, settings)
+
+        # Lay out the new clues now so later renders skip text measurement
+        render_pool.warm(clues[1:], image_output(settings).size)
 
         await ctx.send("Clues have been successfully updated!")
 
@@ -153,7 +459,7 @@ async def set_maro_clues(ctx):
 async def reset_maro_clues(ctx):
     guild_id = ctx.guild.id
 
-    settings = load_settings(f"{guild_id}/settings.json")
+    settings = load_settings(guild_id)
     bingo_role = settings["bingo_role"]
 
     # Check if the user has administrator permissions or bingo role
@@ -162,346 +468,397 @@ async def reset_maro_clues(ctx):
         await ctx.send("You need to be an administrator or have the Bingo Master role to set the clues.")
         return
 
-    ensure_server_directories(guild_id)
-    clues_file = get_clues_file(guild_id)
-
-    shutil.copyfile("clues.txt", clues_file)
-
-@bot.command(name="listMaroClues", help="List all clues")
-async def list_maro_clues(ctx):
-    guild_id = ctx.guild.id
-    clues_file = get_clues_file(guild_id)
-    if not os.path.exists(clues_file):
-        await ctx.send("No clues file found for this server. Please set clues using `/setMaroClues`.")
+    ensure_guild(guild_id)
+    expansion, clues = read_sheet("clues.txt")
+    async with locks.guild(guild_id):
+        save_clues(guild_id, expansion, clues)
+        clue_listings.pop(guild_id, None)
+        odds_cache.pop(guild_id, None)
+        settings = load_settings(guild_id)
+        settings["revealed_clues"] = []
+        settings["bingo_order"] = []
+        save_settings(guild_id, settings)
+    render_pool.warm(clues, image_output(settings).size)
+
+@bot.command(name="listMaroClues", help="List the clues a page at a time. Add a page number and/or words to search for, e.g. /listMaroClues 2 token")
+async def list_maro_clues(ctx, page: Optional[int] = 1, *, search: str = ""):
+    search = search.strip().lower()
+    pages = clue_pages(ctx.guild.id, search)
+    if not pages:
+        await ctx.send(f"No clues match '{search}'.")
         return
-    expansion, clues = read_sheet(clues_file)
-    clues_text = "\n".join(clues)
-    await ctx.send(f"**Clues for {expansion}:**\n```{clues_text}```")
+    page = min(max(page, 1), len(pages)) - 1
+    if len(pages) == 1:
+        await ctx.send(pages[0])
+    else:
+        await ctx.send(pages[page], view=CluePageView(pages, page))
 
 @bot.command(name="createBingoSheet", help="Create a new BINGO sheet for yourself or another user.", aliases=["addBingoSheet", "newBingoSheet"])
 async def create_bingo_sheet(ctx, target_user: discord.Member = None):
     guild_id = ctx.guild.id
-    ensure_server_directories(guild_id)
-    clues_file = get_clues_file(guild_id)
-    bingo_sheets_dir = get_bingo_sheets_directory(guild_id)
-    settings_file = get_settings_file(guild_id)
-    settings = load_settings(settings_file)
-    free_space = settings.get("free_space_enabled", False)
+    ensure_guild(guild_id)
+    settings = load_settings(guild_id)
+    layout = sheet_layout(settings)
     bingo_role = settings.get("bingo_role", "Bingo Master")
     has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
 
     user = target_user if target_user else ctx.author
-    user_bingo_file = os.path.join(bingo_sheets_dir, f"{user.id}.txt")
 
     if target_user and not (ctx.author.guild_permissions.administrator or has_bingo_role):
         await ctx.send("You need admin or Bingo Master role to create sheets for others.")
         return
 
-    if not os.path.exists(clues_file):
+    clue_set = load_clues(guild_id)
+    if clue_set is None:
         await ctx.send("No clues file found. Please set clues using `/setMaroClues`.")
         return
 
-    expansion, clues = read_sheet(clues_file)
+    expansion, clues = clue_set
 
-    if os.path.exists(user_bingo_file):
-        user_expansion, user_clues = read_sheet(user_bingo_file)
-        if user_expansion == expansion:
+    existing_board = load_board(guild_id, user.id)
+    if existing_board:
+        if existing_board.expansion == expansion:
             await ctx.send(f"{user.mention} already has a bingo sheet for '{expansion}'. Overwrite? (yes/no)")
             response = await bot.wait_for("message", timeout=30.0)
             if response.content.lower() != "yes":
                 await ctx.send("Creation canceled.")
                 return
 
-    clue_selection = sample(clues, 25)
-    if free_space:
-        clue_selection[12] = "Free"
-
-    with open(user_bingo_file, 'w') as outfile:
-        outfile.write(f"# {expansion}\n")
-        for c in clue_selection:
-            outfile.write(c + "\n")
+    async with locks.user(guild_id, user.id):
+        board = new_board(expansion, clues, layout)
+        save_board(guild_id, user.id, board)
 
-    # Reset "bingo_declared" for this user
-    user_settings = settings["users"].get(str(user.id), {"bingo_declared": False})
-    user_settings["bingo_declared"] = False
-    settings["users"][str(user.id)] = user_settings
-    save_settings(settings_file, settings)
+        # Reset "bingo_declared" and the leaderboard entry for this user
+        async with locks.guild(guild_id):
+            record_progress(guild_id, {user.id: board})
 
     await ctx.send(f"Bingo sheet created for {user.mention}.")
     await view_bingo_sheet(ctx, user)
 
-@bot.command(name="viewBingoSheet", help="View your BINGO sheet", aliases=["viewBingoCard"])
-async def view_bingo_sheet(message, target_user: discord.Member = None):
-    guild_id = message.guild.id
-    user = target_user if target_user else message.author
-    bingo_sheets_dir = get_bingo_sheets_directory(guild_id)
-    user_bingo_file = os.path.join(bingo_sheets_dir, f"{user.id}.txt")
+@bot.command(name="createBingoSheets", help="Create BINGO sheets for everyone with a role, or for the whole server with 'all'.")
+async def create_bingo_sheets(ctx, target: Union[discord.Role, str]):
+    guild_id = ctx.guild.id
+    ensure_guild(guild_id)
+    settings = load_settings(guild_id)
+    layout = sheet_layout(settings)
+    bingo_role = settings.get("bingo_role", "Bingo Master")
+    has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
 
-    # Check if the user has a bingo sheet
-    if not os.path.exists(user_bingo_file):
-        await message.channel.send("You don't have a bingo sheet yet. Use `/createBingoSheet` to create one.")
+    if not (ctx.author.guild_permissions.administrator or has_bingo_role):
+        await ctx.send("You need admin or Bingo Master role to create sheets for others.")
         return
 
-    # Read the user's bingo sheet clues
-    expansion, clues = read_sheet(user_bingo_file)
-
-    # Ensure we have exactly 25 clues
-    if len(clues) != 25:
-        await message.channel.send("Your bingo sheet data is incomplete.")
+    if not (isinstance(target, discord.Role) or target.lower() == "all"):
+        await ctx.send("Please mention a role or use `all` (e.g., `/createBingoSheets @Players`).")
+        return
+    # Member lists aren't fetched at startup, so fetch this guild's the first time it is needed
+    if not ctx.guild.chunked:
+        await ctx.guild.chunk()
+    members = target.members if isinstance(target, discord.Role) else ctx.guild.members
+    members = [member for member in members if not member.bot]
+
+    clue_set = load_clues(guild_id)
+    if clue_set is None:
+        await ctx.send("No clues file found. Please set clues using `/setMaroClues`.")
         return
 
-    img_size = 600
-    cell_size = 100
-    label_offset = 50
-    img = Image.new('RGB', (img_size, img_size), color='white')
-    draw = ImageDraw.Draw(img)
-
-    try:
-        font = ImageFont.truetype("DejaVuSans.ttf", 15)
-    except IOError:
-        font = ImageFont.load_default()
-
-    column_labels = ['A', 'B', 'C', 'D', 'E']
-    for i, label in enumerate(column_labels):
-        text_x = label_offset + i * cell_size + (cell_size // 2)
-        text_y = label_offset // 2
-        draw.text((text_x, text_y), label, fill="black", font=font, anchor="mm")
-
-    row_labels = ['1', '2', '3', '4', '5']
-    for i, label in enumerate(row_labels):
-        text_x = label_offset // 2
-        text_y = label_offset + i * cell_size + (cell_size // 2)
-        draw.text((text_x, text_y), label, fill="black", font=font, anchor="mm")
-
-    def wrap_text(text, font, max_width):
-        """Wrap text to fit within the specified width."""
-        lines = []
-        words = text.split()
-        current_line = ""
-
-        for word in words:
-            # Check if the word fits on the current line
-            test_line = f"{current_line} {word}".strip()
-            bbox = draw.textbbox((0, 0), test_line, font=font)
-            width = bbox[2] - bbox[0]  # Bounding box width
-
-            if width <= max_width:
-                current_line = test_line  # Add word to current line
-            else:
-                if current_line:  # Push current line to list
-                    lines.append(current_line)
-                current_line = word  # Start new line with the current word
-
-        # Add any remaining text
-        if current_line:
-            lines.append(current_line)
-
-        return lines
-
-    def adjust_font_size(text, font, max_width, max_height):
-        """Adjust the font size to make sure the text fits within the specified max width and height."""
-        original_font = font
-        font_size = font.size
-        adjusted_font = font
-
-        # Try different font sizes until the text fits
-        while True:
-            wrapped_text = wrap_text(text, adjusted_font, max_width)
-            total_height = sum([draw.textbbox((0, 0), line, font=adjusted_font)[3] for line in wrapped_text])
-
-            if total_height <= max_height:  # Text fits vertically
-                # Check if it fits horizontally as well
-                max_line_width = max([draw.textbbox((0, 0), line, font=adjusted_font)[2] -
-                                      draw.textbbox((0, 0), line, font=adjusted_font)[0] for line in wrapped_text])
-                if max_line_width <= max_width:  # Fits horizontally and vertically
-                    break
-
-            # If not, reduce font size
-            font_size -= 1
-            if font_size <= 5:  # Limit font size to a reasonable minimum
-                adjusted_font = original_font
-                break
-            adjusted_font = ImageFont.truetype("DejaVuSans.ttf", font_size)
-
-        return adjusted_font, wrapped_text
-
-    # Draw the grid and clues with crossed-out marks if needed
-    for i in range(5):
-        for j in range(5):
-            x = label_offset + j * cell_size
-            y = label_offset + i * cell_size
-
-            clue_index = i * 5 + j
-            clue = clues[clue_index]
-            text = clue.replace(" X", "")  # Remove " X" if present for display
-
-            # Sanitize problematic characters
-            text = text.replace("\u201c", '"').replace("\u201d", '"')
-
-            draw.rectangle([x, y, x + cell_size, y + cell_size], outline="black", width=2)
-
-            adjusted_font, wrapped_text = adjust_font_size(text, font, cell_size - 10, cell_size - 10)
-
-            # Calculate the total height of the wrapped text
-            total_height = sum([draw.textbbox((0, 0), line, font=adjusted_font)[3] for line in wrapped_text])
-
-            # Start drawing text at the top of the cell, centered
-            current_y = y + (cell_size - total_height) / 2
-
-            for line in wrapped_text:
-                bbox = draw.textbbox((0, 0), line, font=adjusted_font)  # Get bounding box of the line
-                text_width = bbox[2] - bbox[0]
-                text_x = x + (cell_size - text_width) / 2
-                draw.text((text_x, current_y), line, fill="black", font=adjusted_font)
-                current_y += bbox[3] - bbox[1]  # Move to the next line, using the bounding box height
-
-            # If the clue is crossed off, draw a red cross
-            if clue.endswith(" X"):
-                draw.line([x, y, x + cell_size, y + cell_size], fill="red", width=3)
-                draw.line([x + cell_size, y, x, y + cell_size], fill="red", width=3)
-
-    image_path = f"servers/{guild_id}/temp_bingo_{user.id}.png"
-    img.save(image_path)
-
-    with open(image_path, "rb") as f:
-        picture = discord.File(f)
-        await message.channel.send(f"{user.name}'s Bingo Sheet for '{expansion}'", file=picture)
+    expansion, clues = clue_set
 
-    os.remove(image_path)
+    # Members who already have a sheet for this expansion keep it
+    existing_boards = load_boards(guild_id, [member.id for member in members])
+    new_members = [member for member in members
+                   if not (member.id in existing_boards and existing_boards[member.id].expansion == expansion)]
+    if not new_members:
+        await ctx.send(f"Everyone there already has a bingo sheet for '{expansion}'.")
+        return
 
-@bot.command(name="cross", help="Cross off a cell on your BINGO sheet")
-async def cross_off_square(ctx, square: str, target_user: discord.Member = None):
+    boards = {member.id: new_board(expansion, clues, layout) for member in new_members}
+    save_boards(guild_id, boards)
+    async with locks.guild(guild_id):
+        record_progress(guild_id, boards)
+
+    skipped = len(members) - len(new_members)
+    summary = f"Created {len(new_members)} bingo sheet(s) for '{expansion}'."
+    if skipped:
+        summary += f" {skipped} member(s) already had one."
+    await ctx.send(summary)
+
+    # The upload limit counts every attachment of a message together, so each archive gets its own message
+    archives = await render_archives([(f"{member.name}_{member.id}", boards[member.id]) for member in new_members],
+                                     image_output(settings, guild_id), part_bytes=ctx.guild.filesize_limit)
+    with metrics.timed("bingo_phase_seconds", phase="upload"):
+        for i, archive in enumerate(archives):
+            await ctx.send(file=discord.File(io.BytesIO(archive), filename=f"bingo_sheets_{i + 1}.zip"))
+    metrics.increment("bingo_bytes_uploaded_total", sum(len(archive) for archive in archives))
+
+@bot.command(name="reveal", help="Cross a revealed clue off every BINGO sheet in the server.")
+async def reveal_clue(ctx, *, clue: str):
     guild_id = ctx.guild.id
-    bingo_sheets_dir = get_bingo_sheets_directory(guild_id)
-
-    settings_file = get_settings_file(guild_id)
-    settings = load_settings(settings_file)
+    settings = load_settings(guild_id)
     bingo_role = settings.get("bingo_role", "Bingo Master")
     has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
 
-    user = target_user if target_user else ctx.author
-    user_bingo_file = os.path.join(bingo_sheets_dir, f"{user.id}.txt")
-
-    user_settings = settings["users"].get(str(user.id), {"bingo_declared": False})
+    if not (ctx.author.guild_permissions.administrator or has_bingo_role):
+        await ctx.send("You need admin or Bingo Master role to reveal clues.")
+        return
 
-    if target_user and not (ctx.author.guild_permissions.administrator or has_bingo_role):
-        await ctx.send("You need admin or Bingo Master role to cross off cells for others.")
+    clue_set = load_clues(guild_id)
+    if clue_set is None:
+        await ctx.send("No clues file found. Please set clues using `/setMaroClues`.")
         return
 
-    if not os.path.exists(user_bingo_file):
-        if target_user:
-            await ctx.send(f"{user.name} does not have a bingo sheet yet. Use `/createBingoSheet` to create one.")
+    expansion, clues = clue_set
+    clue, candidates = find_clue(clues, clue)
+    if clue is None:
+        if candidates:
+            await send_lines(ctx, ["That matches several clues, please be more specific:"] + candidates)
         else:
-            await ctx.send(f"You don't have a bingo sheet yet. Use `/createBingoSheet` to create one.")
+            await ctx.send("No clue matches that. Use `/listMaroClues` to see the clues.")
         return
 
-    match = re.match(r'([A-E][1-5])', square.upper())
-    if not match:
-        await ctx.send("Please specify a valid square (e.g., `/cross B3`).")
+    # Only sheets for the current expansion take part. The clue index is in storage, so write pending sheets first
+    await storage.flush_async()
+    cells = storage.clue_cells(guild_id, clue)
+    boards = storage.load_boards(guild_id, list(cells))
+    crosses = {user_id: cell_bit(cells[user_id]) for user_id, board in boards.items() if board.expansion == expansion}
+    results = storage.update_crossed_many(guild_id, crosses)
+
+    async with locks.guild(guild_id):
+        settings = load_settings(guild_id)
+        revealed = settings.setdefault("revealed_clues", [])
+        if clue not in revealed:
+            revealed.append(clue)
+        new_winners = record_progress(guild_id, {
+            user_id: board for user_id, (previous, board) in results.items() if board.crossed != previous})
+
+    newly_crossed = sum(1 for previous, board in results.values() if board.crossed != previous)
+    lines = [f"Revealed **{clue}**: crossed off on {newly_crossed} sheet(s)."]
+    if new_winners:
+        lines.append("BINGO! Congratulations " + ", ".join(f"<@{user_id}>" for user_id in new_winners))
+    await send_lines(ctx, lines)
+
+@bot.command(name="leaderboard", help="Show the bingo order and how close everyone is to BINGO.")
+async def leaderboard(ctx, count: int = 20):
+    guild_id = ctx.guild.id
+    async with locks.guild(guild_id):
+        backfill_progress(guild_id)
+    settings = load_settings(guild_id)
+    clue_set = load_clues(guild_id)
+    if clue_set is None:
+        await ctx.send("No clues file found. Please set clues using `/setMaroClues`.")
         return
 
-    square_id = match.group(1)
-    col_letter = square_id[0]
-    row_number = int(square_id[1])
+    expansion, _ = clue_set
 
-    column_index = ord(col_letter) - ord('A')
-    row_index = row_number - 1
-    clue_index = row_index * 5 + column_index
+    def player_name(user_id):
+        member = ctx.guild.get_member(int(user_id))
+        return member.display_name if member else f"<@{user_id}>"
 
-    expansion, clues = read_sheet(user_bingo_file)
+    # Both lists are kept up to date on every cross, so this only has to sort them
+    players = [(user_settings["cells_from_bingo"], int(user_id)) for user_id, user_settings in settings["users"].items()
+               if user_settings.get("expansion") == expansion and "cells_from_bingo" in user_settings]
+    if not players:
+        await ctx.send(f"Nobody has a bingo sheet for '{expansion}' yet.")
+        return
 
-    if clue_index >= len(clues):
-        await ctx.send("Invalid square. Please check your input.")
+    lines = [f"**Leaderboard for {expansion}**"]
+    # Orders recorded before record_progress checked the expansion can hold winners from an earlier one
+    bingo_order = [user_id for user_id in settings.get("bingo_order", [])
+                   if settings["users"].get(str(user_id), {}).get("expansion") == expansion]
+    if bingo_order:
+        lines.append("BINGO order:")
+        lines.extend(f"{place}. {player_name(user_id)}" for place, user_id in enumerate(bingo_order, start=1))
+
+    lines.append("Cells from BINGO:")
+    players.sort()
+    for cells, user_id in players[:max(count, 1)]:
+        lines.append(f"{player_name(user_id)}: {'BINGO' if cells == 0 else cells}")
+    if len(players) > count:
+        lines.append(f"... and {len(players) - count} more player(s).")
+    await send_lines(ctx, lines, allowed_mentions=discord.AllowedMentions.none())
+
+@bot.command(name="odds", help="Estimate everyone's chance of BINGO after more clues are revealed (default: half of the rest).")
+async def odds(ctx, reveals: Optional[int] = None, count: int = 20):
+    guild_id = ctx.guild.id
+    if not numpy_available():
+        await ctx.send("Odds need NumPy, which isn't installed on this bot.")
         return
 
-    if clues[clue_index].endswith(" X"):
-        await ctx.send("This square is already crossed off.")
+    async with locks.guild(guild_id):
+        backfill_progress(guild_id)
+    settings = load_settings(guild_id)
+    clue_set = load_clues(guild_id)
+    if clue_set is None:
+        await ctx.send("No clues file found. Please set clues using `/setMaroClues`.")
         return
 
-    clues[clue_index] += " X"
+    expansion, clues = clue_set
+    revealed = set(settings.get("revealed_clues", []))
+    unrevealed = [clue for clue in clues if clue not in revealed]
+    if reveals is None:
+        reveals = (len(unrevealed) + 1) // 2
+    reveals = min(max(reveals, 0), len(unrevealed))
+
+    cached = odds_cache.setdefault(guild_id, {})
+    chances = cached.get(reveals)
+    if chances is None:
+        user_ids = [int(user_id) for user_id, user_settings in settings["users"].items()
+                    if user_settings.get("expansion") == expansion]
+        boards = {user_id: board for user_id, board in storage.load_boards(guild_id, user_ids).items()
+                  if board.expansion == expansion}
+        with metrics.timed("bingo_phase_seconds", phase="odds"):
+            chances = await asyncio.to_thread(bingo_odds, boards, unrevealed, reveals)
+        # A cross during the simulation replaces cached, so a stale result is never kept
+        cached[reveals] = chances
+    if not chances:
+        await ctx.send(f"Nobody has a bingo sheet for '{expansion}' yet.")
+        return
 
-    with open(user_bingo_file, 'w') as outfile:
-        outfile.write(f"# {expansion}\n")
-        outfile.write("\n".join(clues) + "\n")
+    def player_name(user_id):
+        member = ctx.guild.get_member(user_id)
+        return member.display_name if member else f"<@{user_id}>"
 
-    if check_bingo(clues) and not user_settings.get("bingo_declared", False):
-        await ctx.send(f"BINGO! Congratulations {user.name}")
-        user_settings["bingo_declared"] = True
-        settings["users"][str(user.id)] = user_settings
-        save_settings(settings_file, settings)
+    players = sorted(chances.items(), key=lambda item: item[1], reverse=True)
+    lines = [f"**Chance of BINGO in {expansion} after {reveals} of the {len(unrevealed)} unrevealed clue(s)**"]
+    for user_id, chance in players[:max(count, 1)]:
+        lines.append(f"{player_name(user_id)}: {chance:.0%}")
+    if len(players) > count:
+        lines.append(f"... and {len(players) - count} more player(s).")
+    await send_lines(ctx, lines, allowed_mentions=discord.AllowedMentions.none())
 
-    await view_bingo_sheet(ctx, target_user = user)
+async def show_sheet(channel, guild_id, user, edit=False):
+    """Render a user's sheet and post it to channel, or with edit, replace the image in their last sheet message there."""
+    # Check if the user has a bingo sheet
+    board = load_board(guild_id, user.id)
+    if board is None:
+        await channel.send("You don't have a bingo sheet yet. Use `/createBingoSheet` to create one.")
+        return
 
+    # Ensure we have exactly 25 clues
+    if len(board.clues) != 25:
+        await channel.send("Your bingo sheet data is incomplete.")
+        return
 
-@bot.command(name="uncross", help="Remove a previously set cross")
-async def uncross_square(ctx, square: str, target_user: discord.Member = None):
+    output = image_output(load_settings(guild_id), guild_id)
+    image_data, extension = await render_pool.render(sheet_spec(board), output)
+    if output.format == "auto":
+        auto_formats[(guild_id, output.size, output.quality)] = extension
+    content = f"{user.name}'s Bingo Sheet for '{board.expansion}'"
+    filename = f"bingo_{user.id}.{extension}"
+    sent = None
+    with metrics.timed("bingo_phase_seconds", phase="upload"):
+        previous = recent_sheet_message(guild_id, user.id, channel) if edit else None
+        if previous is not None:
+            try:
+                sent = await previous.edit(content=content, attachments=[discord.File(io.BytesIO(image_data), filename=filename)])
+                metrics.increment("bingo_sheet_edits_total")
+            except discord.HTTPException:
+                pass  # Deleted or no longer editable, post a new one instead
+        if sent is None:
+            sent = await channel.send(content, file=discord.File(io.BytesIO(image_data), filename=filename))
+    metrics.increment("bingo_bytes_uploaded_total", len(image_data))
+    remember_sheet_message(guild_id, user.id, sent)
+
+async def refresh_sheet(ctx, user):
+    """Show a user's sheet after a change, once per burst of changes, editing their last sheet message when possible."""
     guild_id = ctx.guild.id
-    bingo_sheets_dir = get_bingo_sheets_directory(guild_id)
 
-    settings_file = get_settings_file(guild_id)
-    settings = load_settings(settings_file)
-    bingo_role = settings.get("bingo_role", "Bingo Master")
-    has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
+    async def update():
+        # Renders for one user run in order, so an older image never replaces a newer one
+        async with locks.lock("render", guild_id, user.id):
+            await show_sheet(ctx.channel, guild_id, user, edit=True)
 
-    user = target_user if target_user else ctx.author
-    user_bingo_file = os.path.join(bingo_sheets_dir, f"{user.id}.txt")
+    await render_debouncer.call((guild_id, user.id), update)
 
-    user_settings = settings["users"].get(str(user.id), {"bingo_declared": False})
+@bot.command(name="viewBingoSheet", help="View your BINGO sheet", aliases=["viewBingoCard"])
+async def view_bingo_sheet(message, target_user: discord.Member = None):
+    user = target_user if target_user else message.author
+    await show_sheet(message.channel, message.guild.id, user)
 
-    if target_user and not (ctx.author.guild_permissions.administrator or has_bingo_role):
-        await ctx.send("You need admin or Bingo Master role to uncross cells for others.")
-        return
+async def update_squares(ctx, command, masks, target_user, cross):
+    """Cross (or uncross) every cell in masks on a sheet as one update, then check bingo and re-render once."""
+    guild_id = ctx.guild.id
+    user = target_user if target_user else ctx.author
+    verb = "cross off" if cross else "uncross"
+
+    if target_user:
+        settings = load_settings(guild_id)
+        bingo_role = settings.get("bingo_role", "Bingo Master")
+        has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
+        if not (ctx.author.guild_permissions.administrator or has_bingo_role):
+            await ctx.send(f"You need admin or Bingo Master role to {verb} cells for others.")
+            return
 
-    if not os.path.exists(user_bingo_file):
+    board = load_board(guild_id, user.id)
+    if board is None:
         if target_user:
             await ctx.send(f"{user.name} does not have a bingo sheet yet. Use `/createBingoSheet` to create one.")
         else:
             await ctx.send(f"You don't have a bingo sheet yet. Use `/createBingoSheet` to create one.")
         return
 
-    match = re.match(r'([A-E][1-5])', square.upper())
-    if not match:
-        await ctx.send("Please specify a valid square (e.g., `/cross B3`).")
+    if not masks:
+        await ctx.send(f"Please specify valid squares (e.g., `/{command} B3`, `/{command} B3 C4`, "
+                       f"a column `/{command} B`, a row `/{command} 3` or a range `/{command} B1-B4`).")
         return
 
-    square_id = match.group(1)
-    col_letter = square_id[0]
-    row_number = int(square_id[1])
+    mask = 0
+    for square_mask in masks:
+        mask |= square_mask
+    if mask >> len(board.clues):
+        await ctx.send("Invalid square. Please check your input.")
+        return
 
-    column_index = ord(col_letter) - ord('A')
-    row_index = row_number - 1
-    clue_index = row_index * 5 + column_index
+    async with locks.user(guild_id, user.id):
+        if cross:
+            previous, board = update_crossed(guild_id, user.id, cross=mask)
+            changed = mask & ~previous
+        else:
+            previous, board = update_crossed(guild_id, user.id, uncross=mask)
+            changed = mask & previous
+        if not changed:
+            if bin(mask).count("1") == 1:
+                await ctx.send("This square is already crossed off." if cross else "This square was not crossed off.")
+            else:
+                await ctx.send("These squares are already crossed off." if cross else "None of these squares were crossed off.")
+            return
 
-    expansion, clues = read_sheet(user_bingo_file)
+        # Bingo is declared (or taken back) once for the whole batch
+        async with locks.guild(guild_id):
+            new_bingo = record_progress(guild_id, {user.id: board})
 
-    if clue_index >= len(clues):
-        await ctx.send("Invalid square. Please check your input.")
-        return
+    unchanged = [square_name(cell) for cell in range(len(board.clues)) if mask & ~changed & cell_bit(cell)]
+    if unchanged:
+        await ctx.send(f"{'Already crossed off' if cross else 'Not crossed off'}: {', '.join(unchanged)}.")
+    if cross and new_bingo:
+        await ctx.send(f"BINGO! Congratulations {user.name}")
 
-    if not clues[clue_index].endswith(" X"):
-        await ctx.send("This square was not crossed off.")
-        return
+    await refresh_sheet(ctx, user)
 
-    clues[clue_index] = clues[clue_index][:-2]
+async def explain_square_error(ctx, error):
+    """Error handler for /cross and /uncross when an argument is neither a square nor a member."""
+    if isinstance(error, commands.BadArgument):
+        await ctx.send(f"Please specify valid squares (e.g., `/{ctx.command.name} B3 C4`, a column `B`, "
+                       f"a row `3` or a range `B1-B4`), optionally followed by a user.")
+    else:
+        traceback.print_exception(type(error), error, error.__traceback__)
 
-    with open(user_bingo_file, 'w') as outfile:
-        outfile.write(f"# {expansion}\n")
-        outfile.write("\n".join(clues) + "\n")
+@bot.command(name="cross", help="Cross off cells on your BINGO sheet: squares like B3, a column like B, a row like 3 or a range like B1-B4")
+async def cross_off_square(ctx, squares: commands.Greedy[Squares], target_user: discord.Member = None):
+    await update_squares(ctx, "cross", squares, target_user, cross=True)
 
-    # Remove declared bingo if necessary
-    if not check_bingo(clues):
-        user_settings["bingo_declared"] = False
-        settings["users"][str(user.id)] = user_settings
-        save_settings(settings_file, settings)
+@bot.command(name="uncross", help="Remove previously set crosses, given like /cross")
+async def uncross_square(ctx, squares: commands.Greedy[Squares], target_user: discord.Member = None):
+    await update_squares(ctx, "uncross", squares, target_user, cross=False)
 
-    await view_bingo_sheet(ctx, target_user=user)
+cross_off_square.error(explain_square_error)
+uncross_square.error(explain_square_error)
 
 
 @bot.command(name="freeSpace", help="Make middle spaces free")
 async def free_space_on(ctx, toggle: str):
     guild_id = ctx.guild.id
-    settings_file = get_settings_file(guild_id)
-    settings = load_settings(settings_file)
+    settings = load_settings(guild_id)
     bingo_role = settings["bingo_role"]
 
     has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
@@ -511,17 +868,45 @@ async def free_space_on(ctx, toggle: str):
 
     # Check if the toggle input is valid
     toggle = toggle.lower()
+    if toggle not in ("on", "off"):
+        await ctx.send("Invalid option. Use '/freeSpace on' to enable or '/freeSpace off' to disable.")
+        return
+
+    async with locks.guild(guild_id):
+        settings = load_settings(guild_id)
+        settings["free_space_enabled"] = toggle == "on"
+        save_settings(guild_id, settings)
+
     if toggle == "on":
-        settings["free_space_enabled"] = True
         await ctx.send("The middle free space has been enabled.")
-    elif toggle == "off":
-        settings["free_space_enabled"] = False
-        await ctx.send("The middle free space has been disabled.")
     else:
-        await ctx.send("Invalid option. Use '/freeSpace on' to enable or '/freeSpace off' to disable.")
+        await ctx.send("The middle free space has been disabled.")
+
+@bot.command(name="balancedSheets", help="Spread clue categories evenly over new sheets")
+async def balanced_sheets(ctx, toggle: str):
+    guild_id = ctx.guild.id
+    settings = load_settings(guild_id)
+    bingo_role = settings["bingo_role"]
+
+    has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
+    if not (ctx.author.guild_permissions.administrator or has_bingo_role):
+        await ctx.send("You need to be an administrator to change settings.")
+        return
+
+    toggle = toggle.lower()
+    if toggle not in ("on", "off"):
+        await ctx.send("Invalid option. Use '/balancedSheets on' to enable or '/balancedSheets off' to disable.")
         return
 
-    save_settings(settings_file, settings)
+    async with locks.guild(guild_id):
+        settings = load_settings(guild_id)
+        settings["balanced_sheets"] = toggle == "on"
+        save_settings(guild_id, settings)
+
+    if toggle == "on":
+        await ctx.send("New sheets will mix tokens, counters, creature types, rules text and card names evenly over their rows and columns.")
+    else:
+        await ctx.send("New sheets will draw their clues at random.")
 
 @bot.command(name="setRoleName", help="Set role name")
 async def set_role_name(ctx, role_name: str):
@@ -530,22 +915,327 @@ async def set_role_name(ctx, role_name: str):
         await ctx.send("You need to be an administrator to change settings.")
         return
 
-    settings_file = get_settings_file(guild_id)
-    settings = load_settings(settings_file)
-    settings["bingo_role"] = role_name
-    save_settings(settings_file, settings)
+    async with locks.guild(guild_id):
+        settings = load_settings(guild_id)
+        settings["bingo_role"] = role_name
+        save_settings(guild_id, settings)
+
+@bot.command(name="imageOutput", help="Show or set the sheet image size (compact/standard/hidpi), format (auto/png/webp) and quality (lossless/palette).")
+async def set_image_output(ctx, setting: str = None, value: str = None):
+    guild_id = ctx.guild.id
+    settings = load_settings(guild_id)
+    output = image_output(settings)
+    if setting is None:
+        await ctx.send(f"Sheet images: size {output.size}, format {output.format}, quality {output.quality}.")
+        return
+
+    bingo_role = settings.get("bingo_role", "Bingo Master")
+    has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
+    if not (ctx.author.guild_permissions.administrator or has_bingo_role):
+        await ctx.send("You need admin or Bingo Master role to change the image settings.")
+        return
+
+    choices = {"size": tuple(IMAGE_SIZES), "format": IMAGE_FORMATS, "quality": IMAGE_QUALITIES}
+    setting = setting.lower()
+    value = value.lower() if value else None
+    if setting not in choices or value not in choices[setting]:
+        await send_lines(ctx, ["Please use one of:"] + [f"`/imageOutput {name} {'/'.join(values)}`"
+                                                        for name, values in choices.items()])
+        return
+
+    async with locks.guild(guild_id):
+        settings = load_settings(guild_id)
+        settings[f"image_{setting}"] = value
+        save_settings(guild_id, settings)
+    if setting == "size":
+        clue_set = load_clues(guild_id)
+        if clue_set is not None:
+            render_pool.warm(clue_set[1], value)
+    await ctx.send(f"Sheet image {setting} set to {value}.")
+
+@bot.command(name="botStats", help="Show command latencies, render and storage counters.")
+async def bot_stats(ctx):
+    settings = load_settings(ctx.guild.id)
+    bingo_role = settings.get("bingo_role", "Bingo Master")
+    has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
+    if not (ctx.author.guild_permissions.administrator or has_bingo_role):
+        await ctx.send("You need admin or Bingo Master role to view bot stats.")
+        return
+
+    def describe(histogram):
+        return (f"{histogram.count} calls, mean {histogram.sum / histogram.count * 1000:.1f} ms, "
+                f"p50 <= {histogram.quantile(0.5) * 1000:g} ms, p99 <= {histogram.quantile(0.99) * 1000:g} ms")
+
+    lines = ["**Commands**"]
+    for labels, histogram in sorted(metrics.histograms_named("bingo_command_seconds").items()):
+        lines.append(f"{dict(labels)['command']}: {describe(histogram)}")
+    lines.append("**Phases**")
+    for labels, histogram in sorted(metrics.histograms_named("bingo_phase_seconds").items()):
+        lines.append(f"{dict(labels)['phase']}: {describe(histogram)}")
+    lock_stats = locks.stats()
+    lines.append("**Counters**")
+    lines.append(f"Renders: {metrics.counter('bingo_renders_total')}, "
+                 f"bytes uploaded: {metrics.counter('bingo_bytes_uploaded_total')}")
+    for labels, histogram in sorted(metrics.histograms_named("bingo_image_bytes").items()):
+        lines.append(f"{dict(labels)['format']} images: {histogram.count}, "
+                     f"mean {histogram.sum / histogram.count / 1024:.1f} KiB")
+    lines.append(f"Re-renders coalesced: {metrics.counter('bingo_debounced_calls_total')}, "
+                 f"sheets edited in place: {metrics.counter('bingo_sheet_edits_total')}")
+    lines.append(f"File reads: {metrics.counter('bingo_file_reads_total')}, "
+                 f"file writes: {metrics.counter('bingo_file_writes_total')}")
+    lines.append(f"Lock acquisitions: {lock_stats['acquisitions']}, contended: {lock_stats['contended']}, "
+                 f"total wait: {lock_stats['wait_seconds'] * 1000:.1f} ms")
+    lines.append(f"Startup: {metrics.gauge('bingo_startup_seconds'):.1f} s to ready, "
+                 f"{len(storage.guilds)} of {len(bot.guilds)} server(s) loaded")
+    await send_lines(ctx, lines)
+
+@bot.command(name="shardStats", help="Show the health and load of this process's shards.")
+async def shard_stats(ctx):
+    settings = load_settings(ctx.guild.id)
+    bingo_role = settings.get("bingo_role", "Bingo Master")
+    has_bingo_role = discord.utils.get(ctx.author.roles, name=bingo_role)
+    if not (ctx.author.guild_permissions.administrator or has_bingo_role):
+        await ctx.send("You need admin or Bingo Master role to view bot stats.")
+        return
+
+    update_shard_gauges()
+    lines = [f"This server is on shard {ctx.guild.shard_id} of {bot.shard_count}."]
+    for shard_id in sorted(bot.shards):
+        status = "up" if metrics.gauge("bingo_shard_up", shard=shard_id) else "down"
+        latency = metrics.gauge("bingo_shard_latency_seconds", shard=shard_id)
+        guild_count = metrics.gauge("bingo_shard_guilds", shard=shard_id)
+        command_count = metrics.counter("bingo_shard_commands_total", shard=shard_id)
+        lines.append(f"Shard {shard_id}: {status}, latency {latency * 1000:.0f} ms, "
+                     f"{guild_count} server(s), {command_count} command(s)")
+    await send_lines(ctx, lines)
+
+EXPORT_MODES = ("images", "archive", "contact-sheet", "compact")
+
+def expansion_filename(expansion):
+    """A file name for an expansion, e.g. 'Foundations (FDN)' -> 'Foundations_FDN'."""
+    return re.sub(r"[^\w.-]+", "_", expansion or "").strip("_") or "unknown"
+
+def unused_path(path):
+    """path, or path with -2, -3, ... before its extension if that file already exists."""
+    root, extension = os.path.splitext(path)
+    number = 1
+    while os.path.exists(path):
+        number += 1
+        path = f"{root}-{number}{extension}"
+    return path
+
+def write_export(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write(path, mode="wb") as f:
+        f.write(data)
+    return path
+
+def sheets_by_expansion(guild_id):
+    """A guild's sheets as {expansion: [(user_id, Board)]}, each list sorted by user ID."""
+    by_expansion = {}
+    for user_id, board in sorted(storage.load_boards(guild_id, storage.user_ids(guild_id)).items()):
+        by_expansion.setdefault(board.expansion, []).append((user_id, board))
+    return by_expansion
+
+async def export_expansion(mode, directory, expansion, sheets, output, columns=None):
+    """Write one expansion's sheets to directory as images, a zip archive or contact sheets. Returns the paths written."""
+    name = expansion_filename(expansion)
+    named_boards = [(str(user_id), board) for user_id, board in sheets]
+    if mode == "images":
+        return [write_export(os.path.join(directory, name, f"{user_id}.{extension}"), image_data)
+                async for user_id, image_data, extension in render_named(named_boards, output)]
+    if mode == "archive":
+        archive, = await render_archives(named_boards, output)
+        return [write_export(os.path.join(directory, f"{name}.zip"), archive)]
+
+    # The tiles are shrunk to thumbnails anyway, so render them at the smallest size
+    tile_output = output._replace(size="compact")
+    tiles = [(user_id, image_data) async for user_id, image_data, _ in render_named(named_boards, tile_output)]
+    paths = []
+    for start in range(0, len(tiles), CONTACT_SHEET_TILES):
+        page = tiles[start:start + CONTACT_SHEET_TILES]
+        image_data, extension = await render_pool.run(
+            render_contact_sheet, page, columns or math.ceil(math.sqrt(len(page))), output)
+        suffix = f"-{start // CONTACT_SHEET_TILES + 1}" if start else ""
+        paths.append(write_export(os.path.join(directory, f"{name}{suffix}.{extension}"), image_data))
+    return paths
+
+async def compact_expansion(guild_id, directory, expansion, sheets, output):
+    """Move a finished expansion's sheets out of storage into one zip under directory/compacted, with their images
+    and a sheets.json holding the sheets and their players' progress. Returns the archive's path."""
+    archive, = await render_archives([(str(user_id), board) for user_id, board in sheets], output)
+    user_ids = [user_id for user_id, _ in sheets]
+    settings = load_settings(guild_id)
+    data = {
+        "guild_id": guild_id,
+        "expansion": expansion,
+        "sheets": {str(user_id): board.to_dict() for user_id, board in sheets},
+        "players": {str(user_id): settings["users"][str(user_id)] for user_id in user_ids if str(user_id) in settings["users"]},
+    }
+    buffer = io.BytesIO(archive)
+    with zipfile.ZipFile(buffer, "a", zipfile.ZIP_DEFLATED) as zipped:
+        zipped.writestr("sheets.json", json.dumps(data, ensure_ascii=False))
+    # Never replace an earlier archive of the same expansion
+    path = os.path.join(directory, "compacted", f"{expansion_filename(expansion)}.zip")
+    path = write_export(unused_path(path), buffer.getvalue())
+
+    # Only remove the sheets once their archive is safely written
+    storage.delete_boards(guild_id, user_ids)
+    for user_id in user_ids:
+        user_settings = settings["users"].get(str(user_id))
+        if user_settings is not None and user_settings.get("expansion") == expansion:
+            del settings["users"][str(user_id)]
+    save_settings(guild_id, settings)
+    return path
+
+async def export_guilds(args):
+    for guild_id in args.guilds or storage.guild_ids():
+        current_expansion = load_clues(guild_id)[0]
+        guild_output = image_output(load_settings(guild_id))
+        output = ImageOutput(args.image_size or guild_output.size, args.image_format or guild_output.format,
+                             args.image_quality or guild_output.quality)
+        directory = os.path.join(args.output, str(guild_id))
+        for expansion, sheets in sheets_by_expansion(guild_id).items():
+            if args.expansions and expansion not in args.expansions:
+                continue
+            if args.mode != "compact":
+                paths = await export_expansion(args.mode, directory, expansion, sheets, output, args.columns)
+                print(f"Exported {len(sheets)} sheet(s) for '{expansion}' from server {guild_id} to {len(paths)} file(s) in {directory}.")
+            elif expansion == current_expansion:
+                if args.expansions:
+                    print(f"Skipped '{expansion}' in server {guild_id}: it is the server's current expansion.")
+            else:
+                path = await compact_expansion(guild_id, directory, expansion, sheets, output)
+                print(f"Archived {len(sheets)} sheet(s) for '{expansion}' from server {guild_id} to {path}.")
+
+def export_main(argv=None):
+    """python main.py export: render or archive sheets straight from storage, without connecting to Discord."""
+    parser = argparse.ArgumentParser(prog="main.py export",
+                                     description="Render or archive the sheets in storage without connecting to Discord. "
+                                                 "Stop the bot first: this reads and may rewrite the same data.")
+    parser.add_argument('mode', choices=EXPORT_MODES,
+                        help="images: one image per sheet; archive: one zip of images per expansion; "
+                             "contact-sheet: one image of all sheets per expansion; "
+                             "compact: move the sheets of finished expansions out of storage into one zip each")
+    parser.add_argument('--guild', type=int, action='append', dest='guilds',
+                        help='server to export, may be repeated (default: every server)')
+    parser.add_argument('--expansion', type=str, action='append', dest='expansions',
+                        help="expansion to export, may be repeated (default: all; compact never touches a server's current one)")
+    parser.add_argument('--output', type=str, default='exports', help='directory to write to, one subdirectory per server')
+    parser.add_argument('--storage', choices=['files', 'sqlite'], default='files', help='where the guild data is kept')
+    parser.add_argument('--database', type=str, default='bingo.db', help='the SQLite database file')
+    parser.add_argument('--workers', type=int, default=None, help='render processes (default: number of CPUs)')
+    parser.add_argument('--image-size', choices=list(IMAGE_SIZES), default=None, help="default: each server's /imageOutput")
+    parser.add_argument('--image-format', choices=IMAGE_FORMATS, default=None, help="default: each server's /imageOutput")
+    parser.add_argument('--image-quality', choices=IMAGE_QUALITIES, default=None, help="default: each server's /imageOutput")
+    parser.add_argument('--columns', type=int, default=None, help='sheets per row on contact sheets (default: a square grid)')
+    args = parser.parse_args(argv)
+
+    global storage, render_pool
+    storage = GuildStateCache(SQLiteStorage(args.database) if args.storage == 'sqlite' else FileStorage())
+    render_pool.shutdown()
+    render_pool = RenderPool("process", args.workers)
+    try:
+        asyncio.run(export_guilds(args))
+    finally:
+        render_pool.shutdown()
+        storage.close()
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--token', type=str, help='the bot token', default=None)
+    parser.add_argument('--render-backend', choices=['thread', 'process'], default='thread',
+                        help='run sheet rendering in a thread pool or a process pool')
+    parser.add_argument('--render-workers', type=int, default=None,
+                        help='number of render workers (default: number of CPUs)')
+    parser.add_argument('--render-queue', type=int, default=None,
+                        help='maximum number of renders queued or running at once (default: 4 per worker)')
+    parser.add_argument('--render-debounce', type=float, default=2.0,
+                        help='seconds to wait for more /cross or /uncross commands before re-rendering a sheet (0 to disable)')
+    parser.add_argument('--sheet-edit-window', type=float, default=300.0,
+                        help='seconds during which re-rendered sheets replace the image in the last sheet message')
+    parser.add_argument('--storage', choices=['files', 'sqlite'], default='files',
+                        help='keep guild data in per-guild files under servers/ or in one SQLite database')
+    parser.add_argument('--database', type=str, default='bingo.db', help='the SQLite database file')
+    parser.add_argument('--import-servers', action='store_true',
+                        help='copy the servers/ directory tree into the SQLite database before starting')
+    parser.add_argument('--flush-interval', type=float, default=30.0,
+                        help='seconds between writes of changed guild data to storage')
+    parser.add_argument('--flush-threshold', type=int, default=100,
+                        help='write changed guild data as soon as this many changes are pending')
+    parser.add_argument('--metrics-file', type=str, default='metrics.prom',
+                        help='file to write Prometheus text-format metrics to (empty to disable)')
+    parser.add_argument('--metrics-interval', type=float, default=60.0,
+                        help='seconds between metrics file writes')
+    parser.add_argument('--shard-count', type=int, default=None,
+                        help='total number of shards (default: the count Discord recommends)')
+    parser.add_argument('--shard-ids', type=str, default=None,
+                        help="shards this process runs, e.g. '0-3' or '0,2' (default: all)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help='run the shards as this many worker processes, each owning a disjoint set of guilds')
     args = parser.parse_args()
 
+    if args.processes > 1 and args.shard_ids is None:
+        if not args.shard_count:
+            parser.error("--processes needs --shard-count")
+        argv = sys.argv[1:]
+        if args.import_servers and args.storage == 'sqlite':
+            # Import once here rather than in every worker
+            guild_count, sheet_count = import_directory_tree(SQLiteStorage(args.database))
+            print(f"Imported {sheet_count} sheet(s) from {guild_count} server(s) into {args.database}.")
+            argv = [arg for arg in argv if arg != '--import-servers']
+        launch_shard_processes(argv, args.shard_count, args.processes)
+        return
+
+    bot.shard_count = args.shard_count
+    if args.shard_ids is not None:
+        if not args.shard_count:
+            parser.error("--shard-ids needs --shard-count")
+        try:
+            bot.shard_ids = parse_shard_ids(args.shard_ids)
+        except ValueError:
+            parser.error(f"--shard-ids must be shard IDs and ranges like '0-3' or '0,2', not '{args.shard_ids}'")
+        if not bot.shard_ids:
+            parser.error(f"--shard-ids '{args.shard_ids}' names no shards")
+        if not all(0 <= shard_id < args.shard_count for shard_id in bot.shard_ids):
+            parser.error(f"--shard-ids must be between 0 and {args.shard_count - 1}")
+
+    global metrics_file
+    metrics_file = args.metrics_file
+    write_metrics_file.change_interval(seconds=args.metrics_interval)
+
+    global storage
+    if args.storage == 'sqlite':
+        backend = SQLiteStorage(args.database)
+        if args.import_servers:
+            guild_count, sheet_count = import_directory_tree(backend)
+            print(f"Imported {sheet_count} sheet(s) from {guild_count} server(s) into {args.database}.")
+    else:
+        backend = FileStorage()
+    storage = GuildStateCache(backend, args.flush_threshold)
+    flush_guild_state.change_interval(seconds=args.flush_interval)
+
+    global sheet_edit_window
+    render_debouncer.delay = args.render_debounce
+    sheet_edit_window = args.sheet_edit_window
+
+    global render_pool
+    render_pool.shutdown()
+    render_pool = RenderPool(args.render_backend, args.render_workers, args.render_queue)
+
     if not args.token:
         token = os.getenv('DISCORD_BOT_TOKEN')
     else:
         token = args.token
 
-    bot.run(token)
+    try:
+        bot.run(token)
+    finally:
+        render_pool.shutdown()
+        storage.close()
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["export"]:
+        export_main(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,67 @@
+"""Monte Carlo estimate of every player's chance of bingo from the clues that haven't been revealed yet.
+
+Each trial reveals a random choice of the unrevealed clues. All of a guild's sheets are checked at once
+with NumPy: sheets are a matrix of indices into the unrevealed clues, which the reveals of a batch of
+trials turn into crossed cells, and the win lines are tested as array operations.
+"""
+from board import CELLS, WIN_MASKS, cell_bit
+
+# The cells of each win line, as rows of a (12, 5) index array
+LINE_CELLS = tuple(tuple(i for i in range(CELLS) if mask & cell_bit(i)) for mask in WIN_MASKS)
+
+DEFAULT_TRIALS = 2000
+
+# Trials x sheets x cells handled per batch, which bounds the memory a simulation takes
+BATCH_CELLS = 4_000_000
+
+# NumPy is only needed by /odds, so it is imported on first use and the bot runs without it
+
+
+def numpy_available():
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def sheet_matrix(boards, unrevealed):
+    """(cells, crossed) for a {user_id: Board} dict, in its order, as NumPy arrays.
+
+    cells[s, i] is the index in unrevealed of the clue in cell i of sheet s, or -1 when that clue can't
+    be revealed any more, like the free space. crossed[s, i] is whether that cell is crossed; as for
+    Board.has_bingo, the free space only counts once it has been crossed.
+    """
+    import numpy as np
+    positions = {clue: i for i, clue in enumerate(unrevealed)}
+    cells = np.array([[positions.get(clue, -1) for clue in board.clues] for board in boards.values()],
+                     dtype=np.int32).reshape(len(boards), CELLS)
+    crossed = np.array([[board.is_crossed(i) for i in range(CELLS)] for board in boards.values()],
+                       dtype=bool).reshape(len(boards), CELLS)
+    return cells, crossed
+
+
+def bingo_odds(boards, unrevealed, reveals, trials=DEFAULT_TRIALS, seed=None):
+    """{user_id: chance of bingo} once reveals more of the unrevealed clues have been revealed."""
+    import numpy as np
+    if not boards:
+        return {}
+    cells, crossed = sheet_matrix(boards, unrevealed)
+    reveals = max(0, min(reveals, len(unrevealed)))
+    lines = np.array(LINE_CELLS)
+
+    # revealed[t, k] is whether clue k is revealed in trial t. The extra last column is never revealed,
+    # so the -1 entries of cells index it.
+    rng = np.random.default_rng(seed)
+    chosen = rng.random((trials, len(unrevealed))).argsort(axis=1)[:, :reveals]
+    revealed = np.zeros((trials, len(unrevealed) + 1), dtype=bool)
+    np.put_along_axis(revealed, chosen, True, axis=1)
+
+    chances = np.empty(len(boards))
+    batch = max(1, BATCH_CELLS // (trials * CELLS))
+    for start in range(0, len(boards), batch):
+        end = start + batch
+        done = revealed[:, cells[start:end]] | crossed[start:end]  # (trials, sheets, cells)
+        bingo = done[..., lines].all(axis=-1).any(axis=-1)  # (trials, sheets)
+        chances[start:end] = bingo.mean(axis=0)
+    return dict(zip(boards, chances.tolist()))
@@ -0,0 +1,346 @@
+import asyncio
+import io
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+from board import FREE_SPACE
+from metrics import metrics
+
+# Everything a worker needs to draw a sheet: the expansion name, the 25 clue texts
+# (without crossed markers) and the indices of the crossed cells
+SheetSpec = namedtuple("SheetSpec", ["expansion", "clues", "crossed"])
+
+FONT_PATH = "DejaVuSans.ttf"
+BASE_FONT_SIZE = 15
+CELL_SIZE = 100
+LABEL_OFFSET = 50
+
+# Pixel measurements of a sheet at one resolution preset
+Geometry = namedtuple("Geometry", ["cell_size", "label_offset", "font_size", "grid_width", "cross_width"])
+
+IMAGE_SIZES = {
+    "compact": Geometry(70, 35, 11, 2, 2),  # 420x420
+    "standard": Geometry(CELL_SIZE, LABEL_OFFSET, BASE_FONT_SIZE, 2, 3),  # 600x600
+    "hidpi": Geometry(200, 100, 30, 4, 6),  # 1200x1200
+}
+
+# How a sheet is encoded. format is "png", "webp" or "auto" for whichever comes out smaller, which costs
+# an encode of each (the bot remembers the winner per guild and size); quality "lossless" keeps every pixel, "palette" reduces the image to PALETTE_COLORS
+# colors first. Lossless WebP is about a third of the size of a PNG, so it is the default.
+ImageOutput = namedtuple("ImageOutput", ["size", "format", "quality"], defaults=("standard", "webp", "lossless"))
+IMAGE_FORMATS = ("auto", "png", "webp")
+IMAGE_QUALITIES = ("lossless", "palette")
+
+# Contact sheets show every sheet as a thumbnail this wide (half a compact sheet) with a caption under it, and
+# hold at most CONTACT_SHEET_PIXELS per image whatever the image size. Encoding one as lossless WebP peaks
+# at about 20 bytes per pixel.
+CONTACT_TILE_WIDTH = 210
+CONTACT_CAPTION = IMAGE_SIZES["compact"]
+CONTACT_SHEET_PIXELS = 12_000_000
+CONTACT_SHEET_TILES = CONTACT_SHEET_PIXELS // (CONTACT_TILE_WIDTH * (CONTACT_TILE_WIDTH + CONTACT_CAPTION.label_offset))
+
+# Black, white, red and enough greys for the anti-aliased text
+PALETTE_COLORS = 16
+
+# WebP can't encode images wider or taller than this, so larger ones are always PNG
+WEBP_MAX_DIMENSION = 16383
+
+# Upper bounds in bytes for the encoded image size histogram
+IMAGE_BYTES_BUCKETS = (5000, 10000, 20000, 50000, 100000, 200000, 500000)
+
+# Pillow is imported on first use rather than with this module, so the bot starts without it;
+# RenderPool.warm brings it up in the background once the bot is connected
+
+@lru_cache(maxsize=1)
+def measure_draw():
+    """Scratch surface used only for measuring text, never for output."""
+    from PIL import Image, ImageDraw
+    return ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+@lru_cache(maxsize=16)
+def load_font(size):
+    """Load the sheet font at the given size, keeping recently used sizes in memory."""
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except IOError:
+        return ImageFont.load_default()
+
+def display_text(clue):
+    """Sanitize problematic characters for drawing."""
+    return clue.replace("\u201c", '"').replace("\u201d", '"')
+
+def wrap_text(text, font, max_width):
+    """Wrap text to fit within the specified width."""
+    lines = []
+    words = text.split()
+    current_line = ""
+
+    for word in words:
+        # Check if the word fits on the current line
+        test_line = f"{current_line} {word}".strip()
+        bbox = measure_draw().textbbox((0, 0), test_line, font=font)
+        width = bbox[2] - bbox[0]  # Bounding box width
+
+        if width <= max_width:
+            current_line = test_line  # Add word to current line
+        else:
+            if current_line:  # Push current line to list
+                lines.append(current_line)
+            current_line = word  # Start new line with the current word
+
+    # Add any remaining text
+    if current_line:
+        lines.append(current_line)
+
+    return lines
+
+def adjust_font_size(text, base_font_size, max_width, max_height):
+    """Find the largest font size (down from base_font_size) at which the text fits within max width and height."""
+    font_size = base_font_size
+    adjusted_size = font_size
+
+    # Try different font sizes until the text fits
+    while True:
+        adjusted_font = load_font(adjusted_size)
+        wrapped_text = wrap_text(text, adjusted_font, max_width)
+        total_height = sum([measure_draw().textbbox((0, 0), line, font=adjusted_font)[3] for line in wrapped_text])
+
+        if total_height <= max_height:  # Text fits vertically
+            # Check if it fits horizontally as well
+            max_line_width = max([measure_draw().textbbox((0, 0), line, font=adjusted_font)[2] -
+                                  measure_draw().textbbox((0, 0), line, font=adjusted_font)[0] for line in wrapped_text],
+                                 default=0)
+            if max_line_width <= max_width:  # Fits horizontally and vertically
+                break
+
+        # If not, reduce font size
+        font_size -= 1
+        if font_size <= 5:  # Limit font size to a reasonable minimum
+            adjusted_size = base_font_size
+            break
+        adjusted_size = font_size
+
+    return adjusted_size, wrapped_text
+
+@lru_cache(maxsize=4096)
+def layout_clue(text, cell_size, base_font_size):
+    """Fit a clue into a cell and return (font_size, ((line, x, y), ...)) with positions relative to the cell."""
+    font_size, wrapped_text = adjust_font_size(text, base_font_size, cell_size - 10, cell_size - 10)
+    font = load_font(font_size)
+
+    # Calculate the total height of the wrapped text
+    total_height = sum([measure_draw().textbbox((0, 0), line, font=font)[3] for line in wrapped_text])
+
+    # Start at the top of the centered text block
+    current_y = (cell_size - total_height) / 2
+    lines = []
+    for line in wrapped_text:
+        bbox = measure_draw().textbbox((0, 0), line, font=font)  # Get bounding box of the line
+        text_width = bbox[2] - bbox[0]
+        lines.append((line, (cell_size - text_width) / 2, current_y))
+        current_y += bbox[3] - bbox[1]  # Move to the next line, using the bounding box height
+
+    return font_size, tuple(lines)
+
+def warm_layout_cache(clues, size="standard"):
+    """Lay out every clue of a clue set ahead of time so rendering a sheet does no text measurement."""
+    geometry = IMAGE_SIZES[size]
+    for clue in list(clues) + [FREE_SPACE]:
+        if clue.startswith("#"):
+            continue
+        layout_clue(display_text(clue), geometry.cell_size, geometry.font_size)
+
+# Memory each size's cache of sheet bases may use; a base is 0.5 MB compact, 1.1 MB standard and 4.3 MB hidpi
+BASE_CACHE_BYTES = 48_000_000
+
+@lru_cache(maxsize=None)
+def base_cache(size):
+    """draw_base behind an LRU cache holding as many bases of size as fit in BASE_CACHE_BYTES."""
+    cell_size, label_offset = IMAGE_SIZES[size][:2]
+    img_size = label_offset + 5 * cell_size + label_offset
+    return lru_cache(maxsize=max(1, BASE_CACHE_BYTES // (3 * img_size * img_size)))(draw_base)
+
+def render_base(clues, size="standard"):
+    """The un-crossed grid, labels and clue texts for a tuple of 25 clues at a resolution preset.
+
+    Bases are cached so crossing a cell only has to draw the red overlays on a copy.
+    Callers must copy the returned image before drawing on it.
+    """
+    return base_cache(size)(clues, size)
+
+def draw_base(clues, size):
+    from PIL import Image, ImageDraw
+    cell_size, label_offset, font_size, grid_width, _ = IMAGE_SIZES[size]
+    img_size = label_offset + 5 * cell_size + label_offset
+    img = Image.new('RGB', (img_size, img_size), color='white')
+    draw = ImageDraw.Draw(img)
+
+    font = load_font(font_size)
+
+    column_labels = ['A', 'B', 'C', 'D', 'E']
+    for i, label in enumerate(column_labels):
+        text_x = label_offset + i * cell_size + (cell_size // 2)
+        text_y = label_offset // 2
+        draw.text((text_x, text_y), label, fill="black", font=font, anchor="mm")
+
+    row_labels = ['1', '2', '3', '4', '5']
+    for i, label in enumerate(row_labels):
+        text_x = label_offset // 2
+        text_y = label_offset + i * cell_size + (cell_size // 2)
+        draw.text((text_x, text_y), label, fill="black", font=font, anchor="mm")
+
+    # Draw the grid and clues
+    for i in range(5):
+        for j in range(5):
+            x, y = cell_origin(i * 5 + j, size)
+            text = display_text(clues[i * 5 + j])
+
+            draw.rectangle([x, y, x + cell_size, y + cell_size], outline="black", width=grid_width)
+
+            # Font size and line positions come from the layout cache, so no text is measured here
+            clue_font_size, lines = layout_clue(text, cell_size, font_size)
+            adjusted_font = load_font(clue_font_size)
+            for line, offset_x, offset_y in lines:
+                draw.text((x + offset_x, y + offset_y), line, fill="black", font=adjusted_font)
+
+    return img
+
+def cell_origin(clue_index, size="standard"):
+    """Top-left pixel of a cell, with cells numbered row by row."""
+    geometry = IMAGE_SIZES[size]
+    row, col = divmod(clue_index, 5)
+    return geometry.label_offset + col * geometry.cell_size, geometry.label_offset + row * geometry.cell_size
+
+def render_sheet(sheet, size="standard"):
+    """Draw a bingo sheet described by a SheetSpec at a resolution preset and return the image."""
+    from PIL import ImageDraw
+    img = render_base(tuple(sheet.clues), size).copy()
+    draw = ImageDraw.Draw(img)
+    cell_size, cross_width = IMAGE_SIZES[size].cell_size, IMAGE_SIZES[size].cross_width
+
+    # Draw a red cross over every crossed-off clue
+    for clue_index in sorted(sheet.crossed):
+        x, y = cell_origin(clue_index, size)
+        draw.line([x, y, x + cell_size, y + cell_size], fill="red", width=cross_width)
+        draw.line([x + cell_size, y, x, y + cell_size], fill="red", width=cross_width)
+
+    return img
+
+@lru_cache(maxsize=1)
+def webp_supported():
+    from PIL import features
+    return features.check("webp")
+
+def save_image(img, image_format, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, **options)
+    return buffer.getvalue()
+
+def encode_image(img, image_format="auto", quality="lossless"):
+    """Encode img in every way image_format and quality allow and return the smallest as (bytes, file extension)."""
+    if quality == "palette":
+        img = img.quantize(PALETTE_COLORS)
+    elif img.getcolors(256) is not None:
+        # Few enough colors for a palette that loses nothing
+        img = img.quantize(256)
+
+    candidates = []
+    if image_format in ("auto", "webp") and webp_supported() and max(img.size) <= WEBP_MAX_DIMENSION:
+        # Higher methods take twice as long to save under 1%
+        candidates.append((save_image(img, "WEBP", lossless=True, method=2), "webp"))
+    if image_format in ("auto", "png") or not candidates:
+        # optimize would quadruple the time for about 6% smaller files
+        candidates.append((save_image(img, "PNG"), "png"))
+    return min(candidates, key=lambda candidate: len(candidate[0]))
+
+def render_contact_sheet(tiles, columns, output=ImageOutput()):
+    """Lay out encoded sheet images, given as (caption, image bytes) pairs, as thumbnails in a grid of columns with
+    each caption under its sheet, and encode the result as output describes. Returns (image bytes, file extension).
+
+    Pass at most CONTACT_SHEET_TILES square sheets to stay within CONTACT_SHEET_PIXELS.
+    """
+    from PIL import Image, ImageDraw
+    with Image.open(io.BytesIO(tiles[0][1])) as first:
+        width = CONTACT_TILE_WIDTH
+        height = round(first.height * width / first.width)
+    caption_height = CONTACT_CAPTION.label_offset
+    rows = -(-len(tiles) // columns)
+    img = Image.new('RGB', (columns * width, rows * (height + caption_height)), color='white')
+    draw = ImageDraw.Draw(img)
+    font = load_font(CONTACT_CAPTION.font_size)
+    for i, (caption, image_data) in enumerate(tiles):
+        row, col = divmod(i, columns)
+        x, y = col * width, row * (height + caption_height)
+        # Decode one tile at a time so only the canvas stays in memory
+        with Image.open(io.BytesIO(image_data)) as tile:
+            img.paste(tile.convert('RGB').resize((width, height), Image.LANCZOS), (x, y))
+        draw.text((x + width // 2, y + height + caption_height // 2), caption, fill="black", font=font, anchor="mm")
+    return encode_image(img, output.format, output.quality)
+
+def render_sheet_timed(sheet, output=ImageOutput()):
+    """Render and encode a sheet. Returns (image bytes, file extension, seconds spent drawing, seconds spent encoding)."""
+    start = time.perf_counter()
+    img = render_sheet(sheet, output.size)
+    drawn = time.perf_counter()
+    image_data, extension = encode_image(img, output.format, output.quality)
+    return image_data, extension, drawn - start, time.perf_counter() - drawn
+
+def warm_worker():
+    """Render pool initializer: load Pillow and the base fonts so no worker's first render has to."""
+    from PIL import ImageDraw  # noqa: F401
+    for geometry in IMAGE_SIZES.values():
+        load_font(geometry.font_size)
+
+class RenderPool:
+    """Renders sheets in a thread or process pool so drawing never blocks the event loop.
+
+    At most max_pending renders are queued or running at once; further callers wait for a free
+    slot, which keeps a burst of commands from piling unbounded work onto the executor.
+    """
+
+    def __init__(self, backend="thread", workers=None, max_pending=None):
+        if backend not in ("thread", "process"):
+            raise ValueError(f"Unknown render backend '{backend}', expected 'thread' or 'process'")
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        if backend == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render",
+                                               initializer=warm_worker)
+        self.slots = asyncio.Semaphore(max_pending or self.workers * 4)
+
+    async def run(self, func, *args):
+        with metrics.timed("bingo_phase_seconds", phase="render_queue"):
+            await self.slots.acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.slots.release()
+
+    async def render(self, sheet, output=ImageOutput()):
+        """Render and encode a sheet as output describes. Returns (image bytes, file extension)."""
+        image_data, extension, render_seconds, encode_seconds = await self.run(render_sheet_timed, sheet, output)
+        metrics.observe("bingo_phase_seconds", render_seconds, phase="render")
+        metrics.observe("bingo_phase_seconds", encode_seconds, phase="encode")
+        metrics.increment("bingo_renders_total")
+        metrics.observe("bingo_image_bytes", len(image_data), buckets=IMAGE_BYTES_BUCKETS, format=extension)
+        return image_data, extension
+
+    def warm(self, clues, size="standard"):
+        """Fill the layout cache for a clue set in the background.
+
+        Process workers each keep their own cache, so each is sent a job, but the executor may hand
+        several to one worker; a worker that gets none lays clues out on its first renders instead.
+        warm_worker loads Pillow and the fonts in every worker when it starts.
+        """
+        for _ in range(self.workers if self.backend == "process" else 1):
+            self.executor.submit(warm_layout_cache, list(clues), size)
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,91 @@
+import subprocess
+import sys
+import time
+
+
+def shard_for_guild(guild_id, shard_count):
+    """The shard Discord delivers a guild's events to."""
+    return (guild_id >> 22) % shard_count
+
+
+def split_shards(shard_count, processes):
+    """Split shard IDs 0..shard_count-1 into contiguous, disjoint ranges, one per process."""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def parse_shard_ids(text):
+    """Parse '0,1,2' or '0-2' into a list of shard IDs."""
+    shard_ids = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            shard_ids.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            shard_ids.append(int(part))
+    return shard_ids
+
+
+class FakeGateway:
+    """Stands in for Discord's gateway when testing sharding locally.
+
+    It assigns guild IDs to shards with the same formula Discord uses, so a test can check which
+    process owns which guild without connecting.
+    """
+
+    def __init__(self, shard_count, guild_ids):
+        self.shard_count = shard_count
+        self.guild_ids = list(guild_ids)
+
+    def shard_of(self, guild_id):
+        return shard_for_guild(guild_id, self.shard_count)
+
+    def guilds_for_shards(self, shard_ids):
+        shard_ids = set(shard_ids)
+        return [guild_id for guild_id in self.guild_ids if self.shard_of(guild_id) in shard_ids]
+
+    def assignment(self, processes):
+        """{process index: guild IDs} for the shard ranges split_shards gives each process."""
+        return {i: self.guilds_for_shards(shard_ids)
+                for i, shard_ids in enumerate(split_shards(self.shard_count, processes))}
+
+
+def launch_shard_processes(argv, shard_count, processes, restart_delay=5.0):
+    """Run the bot as one worker process per shard range and restart workers that exit.
+
+    Each worker is this script started again with argv plus its own --shard-ids and metrics file, so it
+    owns a disjoint set of guilds and can cache their state without coordinating with the others.
+    """
+    ranges = split_shards(shard_count, processes)
+
+    def start(i):
+        shard_ids = ranges[i]
+        command = [sys.executable, sys.argv[0], *argv,
+                   "--shard-count", str(shard_count),
+                   "--shard-ids", ",".join(map(str, shard_ids)),
+                   "--metrics-file", f"metrics.shard{shard_ids[0]}-{shard_ids[-1]}.prom"]
+        print(f"Starting worker {i} for shard(s) {shard_ids[0]}-{shard_ids[-1]} of {shard_count}.")
+        return subprocess.Popen(command)
+
+    workers = [start(i) for i in range(len(ranges))]
+    try:
+        while True:
+            time.sleep(restart_delay)
+            for i, worker in enumerate(workers):
+                if worker.poll() is not None:
+                    print(f"Worker {i} exited with code {worker.returncode}, restarting.")
+                    workers[i] = start(i)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
@@ -0,0 +1,303 @@
+import asyncio
+import copy
+import threading
+import traceback
+
+from metrics import metrics
+
+
+class GuildState:
+    """Everything the bot has loaded for one guild, plus what still has to be written back."""
+
+    def __init__(self, guild_id, settings):
+        self.guild_id = guild_id
+        self.settings = settings
+        self.clues = None
+        self.clues_loaded = False
+        self.boards = {}  # user_id -> Board, or None for users known to have no sheet
+        self.initialized = False
+        self.settings_dirty = False
+        self.clues_dirty = False
+        self.dirty_boards = set()
+        self.reindex_boards = set()  # The dirty sheets whose clues may have changed, not just their crossed cells
+
+    def dirty_count(self):
+        return int(self.settings_dirty) + int(self.clues_dirty) + len(self.dirty_boards)
+
+
+class GuildStateCache:
+    """Write-behind cache in front of a storage backend.
+
+    Each guild is loaded from the backend once and then served from memory. Changes only mark the
+    guild dirty; they reach the backend when a flush runs, which the bot does on a timer, on shutdown
+    and whenever flush_threshold changes are pending. It has the same interface as the backends, so it
+    can stand in for one.
+
+    Inside an event loop, flush_async() copies the pending changes on the loop and writes the copy in a
+    thread, so disk writes and fsyncs never block it. Every write to the backend takes a ticket when it
+    is queued and runs in ticket order, so an older copy never lands on top of a newer one.
+    """
+
+    def __init__(self, backend, flush_threshold=100):
+        self.backend = backend
+        self.flush_threshold = flush_threshold
+        self.guilds = {}
+        self.pending = 0
+        self.flush_task = None
+        self.write_turn = threading.Condition()
+        self.tickets_issued = 0
+        self.tickets_written = 0
+
+    def get(self, guild_id):
+        state = self.guilds.get(guild_id)
+        if state is None:
+            state = GuildState(guild_id, self.backend.load_settings(guild_id))
+            self.guilds[guild_id] = state
+        return state
+
+    def mark_dirty(self, count=1):
+        self.pending += count
+        if self.pending < self.flush_threshold:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()  # No event loop, e.g. an import, so there is nothing to block
+            return
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_in_background())
+
+    async def flush_in_background(self):
+        try:
+            while self.pending >= self.flush_threshold:
+                await self.flush_async()
+        except Exception:
+            traceback.print_exc()
+
+    def transaction(self):
+        return self.backend.transaction()
+
+    def ensure_guild(self, guild_id):
+        state = self.get(guild_id)
+        if not state.initialized:
+            self.backend.ensure_guild(guild_id)
+            state.initialized = True
+
+    def guild_ids(self):
+        return sorted(set(self.backend.guild_ids()) | set(self.guilds))
+
+    def load_settings(self, guild_id):
+        return self.get(guild_id).settings
+
+    def save_settings(self, guild_id, settings):
+        state = self.get(guild_id)
+        state.settings = settings
+        state.settings_dirty = True
+        self.mark_dirty()
+
+    def load_clues(self, guild_id):
+        state = self.get(guild_id)
+        if not state.clues_loaded:
+            state.clues = self.backend.load_clues(guild_id)
+            state.clues_loaded = True
+        return state.clues
+
+    def save_clues(self, guild_id, expansion, clues):
+        state = self.get(guild_id)
+        state.clues = (expansion, list(clues))
+        state.clues_loaded = True
+        state.clues_dirty = True
+        self.mark_dirty()
+
+    def user_ids(self, guild_id):
+        state = self.get(guild_id)
+        known = {user_id for user_id, board in state.boards.items() if board is not None}
+        return sorted(known | set(self.backend.user_ids(guild_id)))
+
+    def load_board(self, guild_id, user_id):
+        state = self.get(guild_id)
+        if user_id not in state.boards:
+            state.boards[user_id] = self.backend.load_board(guild_id, user_id)
+        return state.boards[user_id]
+
+    def load_boards(self, guild_id, user_ids):
+        """Load several sheets as a {user_id: Board} dict, fetching the ones not in memory in one backend call."""
+        state = self.get(guild_id)
+        missing = [user_id for user_id in user_ids if user_id not in state.boards]
+        if missing:
+            loaded = self.backend.load_boards(guild_id, missing)
+            for user_id in missing:
+                state.boards[user_id] = loaded.get(user_id)
+        return {user_id: state.boards[user_id] for user_id in user_ids if state.boards[user_id] is not None}
+
+    def clue_cells(self, guild_id, clue):
+        """Every sheet containing clue, as {user_id: cell index}.
+
+        The backend keeps the index, so pending sheets are written first and the read waits for writes
+        already queued; await flush_async() before calling this from the event loop to keep both off the loop.
+        """
+        if self.get(guild_id).dirty_boards:
+            self.flush()
+        return self.in_turn(self.take_ticket(), self.backend.clue_cells, guild_id, clue)
+
+    def save_board(self, guild_id, user_id, board):
+        state = self.get(guild_id)
+        state.boards[user_id] = board
+        state.dirty_boards.add(user_id)
+        state.reindex_boards.add(user_id)
+        self.mark_dirty()
+
+    def save_boards(self, guild_id, boards):
+        """Save many sheets at once from a {user_id: Board} dict."""
+        state = self.get(guild_id)
+        state.boards.update(boards)
+        state.dirty_boards.update(boards)
+        state.reindex_boards.update(boards)
+        self.mark_dirty(len(boards))
+
+    def delete_boards(self, guild_id, user_ids):
+        """Remove sheets right away, dropping any unwritten changes to them."""
+        state = self.get(guild_id)
+        for user_id in user_ids:
+            state.boards[user_id] = None
+            state.dirty_boards.discard(user_id)
+            state.reindex_boards.discard(user_id)
+        # After any queued write of these sheets, which would otherwise bring them back
+        self.in_turn(self.take_ticket(), self.backend.delete_boards, guild_id, user_ids)
+
+    def update_crossed(self, guild_id, user_id, cross=0, uncross=0):
+        """Set the cells in cross and clear the cells in uncross (both bitmasks).
+
+        Returns (previous crossed mask, updated board), or None if the user has no sheet.
+        """
+        board = self.load_board(guild_id, user_id)
+        if board is None:
+            return None
+        previous = board.crossed
+        board.crossed = (previous | cross) & ~uncross
+        if board.crossed != previous:
+            self.get(guild_id).dirty_boards.add(user_id)
+            self.mark_dirty()
+        return previous, board
+
+    def update_crossed_many(self, guild_id, crosses):
+        """Cross cells on many sheets at once from a {user_id: bitmask} dict.
+
+        Returns {user_id: (previous crossed mask, updated board)} for the users that have a sheet.
+        """
+        state = self.get(guild_id)
+        results = {}
+        for user_id, board in self.load_boards(guild_id, list(crosses)).items():
+            previous = board.crossed
+            board.crossed |= crosses[user_id]
+            if board.crossed != previous:
+                state.dirty_boards.add(user_id)
+            results[user_id] = (previous, board)
+        self.mark_dirty(len(results))
+        return results
+
+    def take_ticket(self):
+        self.tickets_issued += 1
+        return self.tickets_issued - 1
+
+    def in_turn(self, ticket, func, *args):
+        """Run func(*args) once every write with an earlier ticket has run. Safe to call from any thread."""
+        with self.write_turn:
+            self.write_turn.wait_for(lambda: self.tickets_written == ticket)
+            try:
+                return func(*args)
+            finally:
+                self.tickets_written += 1
+                self.write_turn.notify_all()
+
+    def take_dirty(self):
+        """Copy every guild's pending changes as [(guild_id, settings, clues, {user_id: (board, copy)}, reindex)]
+        and mark them written, where reindex holds the users whose clues may have changed. Nothing the copies
+        share with the cache is changed in place afterwards."""
+        dirty = []
+        for state in self.guilds.values():
+            if not state.dirty_count():
+                continue
+            dirty.append((state.guild_id,
+                          copy.deepcopy(state.settings) if state.settings_dirty else None,
+                          state.clues if state.clues_dirty else None,
+                          {user_id: (state.boards[user_id], state.boards[user_id].copy())
+                           for user_id in state.dirty_boards},
+                          state.reindex_boards))
+            state.settings_dirty = state.clues_dirty = False
+            state.dirty_boards = set()
+            state.reindex_boards = set()
+        self.pending = 0
+        return dirty
+
+    def write_dirty(self, dirty):
+        """Write copies from take_dirty to the backend, one transaction per guild."""
+        if not dirty:
+            return
+        with metrics.timed("bingo_phase_seconds", phase="flush"):
+            for guild_id, settings, clues, boards, reindex in dirty:
+                with self.backend.transaction():
+                    if settings is not None:
+                        self.backend.save_settings(guild_id, settings)
+                    if clues is not None:
+                        self.backend.save_clues(guild_id, *clues)
+                    reindexed = {user_id: saved for user_id, (_, saved) in boards.items() if user_id in reindex}
+                    crossed = {user_id: saved for user_id, (_, saved) in boards.items() if user_id not in reindex}
+                    if reindexed:
+                        self.backend.save_boards(guild_id, reindexed)
+                    if crossed:
+                        self.backend.save_boards(guild_id, crossed, reindex=False)
+
+    def finish_dirty(self, dirty, written):
+        """After a write: keep what the backend learned about each sheet, or mark everything dirty again if it failed."""
+        for guild_id, settings, clues, boards, reindex in dirty:
+            state = self.get(guild_id)
+            if not written:
+                state.settings_dirty |= settings is not None
+                state.clues_dirty |= clues is not None
+                state.dirty_boards.update(boards)
+                state.reindex_boards.update(reindex)
+                self.pending += len(boards) + (settings is not None) + (clues is not None)
+                continue
+            for board, saved in boards.values():
+                board.clue_set, board.seed = saved.clue_set, saved.seed
+
+    @staticmethod
+    def dirty_writes(dirty):
+        return sum(len(boards) + (settings is not None) + (clues is not None) for _, settings, clues, boards, _ in dirty)
+
+    def flush(self):
+        """Write every pending change to the backend on this thread. Returns the number of writes."""
+        dirty = self.take_dirty()
+        if not dirty:
+            return 0
+        written = False
+        try:
+            self.in_turn(self.take_ticket(), self.write_dirty, dirty)
+            written = True
+        finally:
+            self.finish_dirty(dirty, written)
+        return self.dirty_writes(dirty)
+
+    async def flush_async(self):
+        """Like flush(), but the writing happens in a thread so the event loop keeps running.
+
+        Also waits for writes other flushes have already queued, so everything saved before the call is
+        in the backend when it returns.
+        """
+        dirty = self.take_dirty()
+        if not dirty and self.tickets_written == self.tickets_issued:
+            return 0
+        written = False
+        try:
+            # Shielded: a ticket has to be used even if the flush is cancelled, or later writes would wait forever
+            loop = asyncio.get_running_loop()
+            await asyncio.shield(loop.run_in_executor(None, self.in_turn, self.take_ticket(), self.write_dirty, dirty))
+            written = True
+        finally:
+            self.finish_dirty(dirty, written)
+        return self.dirty_writes(dirty)
+
+    def close(self):
+        self.flush()
+        self.backend.close()
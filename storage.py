@@ -0,0 +1,705 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import tempfile
+from collections import namedtuple
+
+from board import FREE_SPACE, Board
+from generator import generate_cells
+from metrics import metrics
+
+DEFAULT_CLUES_FILE = "clues.txt"
+
+# mkstemp creates files readable only by their owner; atomic_write gives them the usual permissions instead.
+# Reading the umask means setting it, which is only safe at import, before other threads exist.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def default_settings():
+    return {
+        "free_space_enabled": False,
+        "bingo_role": "Bingo Master",
+        "users": {}
+    }
+
+
+@contextlib.contextmanager
+def atomic_write(path, encoding='utf-8', mode="w"):
+    """Open a temporary file next to path for writing and move it over path once the block succeeds.
+
+    A crash mid-write leaves the previous file intact instead of a truncated one. Use mode "wb" for bytes.
+    """
+    # A unique name, so processes writing the same file at once don't share a temporary file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.", suffix=".tmp")
+    metrics.increment("bingo_file_writes_total")
+    try:
+        os.chmod(temp_path, 0o666 & ~UMASK)
+        with open(fd, mode, encoding=None if "b" in mode else encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_sheet(path):
+    expansion = None
+    clues = []
+    metrics.increment("bingo_file_reads_total")
+    with open(path, 'r', encoding='utf-8') as infile:
+        for line in infile:
+            if line.startswith("#"):
+                expansion = line[1:].strip()
+            else:
+                clues.append(line.strip())
+    return expansion, clues
+
+
+def index_board(index, user_id, board):
+    """Point every clue of board at its cell in an {clue: {user_id (str): cell}} index. Returns whether it changed."""
+    user_key = str(user_id)
+    cells = {clue: cell for cell, clue in enumerate(board.clues)}
+    changed = False
+    for clue, users in list(index.items()):
+        if user_key in users and cells.get(clue) != users[user_key]:
+            del users[user_key]
+            changed = True
+            if not users:
+                del index[clue]
+    for clue, cell in cells.items():
+        users = index.setdefault(clue, {})
+        if users.get(user_key) != cell:
+            users[user_key] = cell
+            changed = True
+    return changed
+
+
+# A stored clue set: its content-addressed ID, expansion name, clues, and {clue: index} for encoding sheets
+ClueSet = namedtuple("ClueSet", ["id", "expansion", "clues", "positions"])
+
+
+def clue_set_id(expansion, clues):
+    """Content address of a clue set: the same expansion and clues always get the same ID."""
+    data = json.dumps([expansion, list(clues)], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def make_clue_set(expansion, clues, set_id=None):
+    clues = tuple(clues)
+    positions = {}
+    for i, clue in enumerate(clues):
+        positions.setdefault(clue, i)
+    return ClueSet(set_id or clue_set_id(expansion, clues), expansion, clues, positions)
+
+
+class ClueSets:
+    """A backend's content-addressed clue sets, kept in memory once read or written.
+
+    Sheets refer to the set their clues were drawn from and store only the index of each cell's clue,
+    so a sheet stays valid after its guild moves on to new clues. Sets never change once stored, so the
+    cache never goes stale. read(set_id) returns (expansion, clues) or None; write(clue_set) stores a
+    set that may already be stored.
+    """
+
+    def __init__(self, read, write):
+        self.read = read
+        self.write = write
+        self.sets = {}
+        self.default_set = None
+
+    def get(self, set_id):
+        """The stored set with this ID, or None."""
+        clue_set = self.sets.get(set_id)
+        if clue_set is None:
+            stored = self.read(set_id)
+            if stored is None:
+                return None
+            clue_set = self.sets[set_id] = make_clue_set(*stored, set_id)
+        return clue_set
+
+    def put(self, expansion, clues):
+        """Store a set unless it is already stored, and return it."""
+        clue_set = make_clue_set(expansion, clues)
+        if clue_set.id not in self.sets:
+            self.write(clue_set)
+            self.sets[clue_set.id] = clue_set
+        return self.sets[clue_set.id]
+
+    def default(self):
+        """The bot's default clues, shared by every guild that hasn't set its own."""
+        if self.default_set is None:
+            self.default_set = self.put(*read_sheet(DEFAULT_CLUES_FILE))
+        return self.default_set
+
+    def resolve(self, board, current):
+        """The set board's clues come from: the one it was loaded from, the guild's current one, the default one,
+        or failing those a new set of its own clues."""
+        candidates = (self.get(board.clue_set) if board.clue_set else None, current, self.default())
+        for clue_set in candidates:
+            if clue_set is not None and clue_set.expansion == board.expansion and all(
+                    clue in clue_set.positions or clue == FREE_SPACE for clue in board.clues):
+                return clue_set
+        return self.put(board.expansion, [clue for clue in board.clues if clue != FREE_SPACE])
+
+    def encode(self, board, current):
+        """(clue set ID, cell indices, seed, layout) to store for board, given the guild's current set.
+
+        A generated sheet whose seed still reproduces it from the set is stored as its seed and layout,
+        with cell indices None; other sheets get seed None. Sets board.clue_set.
+        """
+        clue_set = self.resolve(board, current)
+        # Once a sheet has been saved to a set its seed is known to match, so it's only checked the first time
+        if board.seed is not None and board.clue_set != clue_set.id and generate_cells(
+                clue_set.clues, board.seed, board.layout) != board.clue_set_cells(clue_set.positions):
+            board.seed = None
+        board.clue_set = clue_set.id
+        if board.seed is not None:
+            return clue_set.id, None, board.seed, board.layout
+        return clue_set.id, board.clue_set_cells(clue_set.positions), None, 0
+
+    def decode(self, set_id, cells, crossed, seed=None, layout=0):
+        """Board for a stored sheet; sheets stored with a seed are regenerated from it."""
+        clue_set = self.get(set_id)
+        if seed is not None:
+            cells = generate_cells(clue_set.clues, seed, layout)
+        return Board.from_clue_set(clue_set, cells, crossed, seed, layout)
+
+
+class FileStorage:
+    """Keeps each guild in servers/<guild_id>: settings.json, clue_set.txt and one JSON file per sheet.
+
+    Clue sets are stored once under servers/clue_sets/<id>.json. clue_set.txt names the guild's current
+    set; guilds without one use the default clues.
+    """
+
+    def __init__(self, root="servers"):
+        self.root = root
+        self.clue_sets = ClueSets(self.read_clue_set, self.write_clue_set)
+        self.guild_clue_sets = {}  # guild_id -> current clue set ID
+
+    def get_server_directory(self, guild_id):
+        return os.path.join(self.root, str(guild_id))
+
+    def get_settings_file(self, guild_id):
+        return os.path.join(self.get_server_directory(guild_id), "settings.json")
+
+    def get_clues_file(self, guild_id):
+        """The guild's own copy of its clues, as kept before clue sets were shared."""
+        return os.path.join(self.get_server_directory(guild_id), "clues.txt")
+
+    def get_clue_set_pointer_file(self, guild_id):
+        return os.path.join(self.get_server_directory(guild_id), "clue_set.txt")
+
+    def get_clue_set_file(self, set_id):
+        return os.path.join(self.root, "clue_sets", f"{set_id}.json")
+
+    def get_bingo_sheets_directory(self, guild_id):
+        return os.path.join(self.get_server_directory(guild_id), "bingo_sheets")
+
+    def get_sheet_file(self, guild_id, user_id):
+        return os.path.join(self.get_bingo_sheets_directory(guild_id), f"{user_id}.json")
+
+    def get_legacy_sheet_file(self, guild_id, user_id):
+        return os.path.join(self.get_bingo_sheets_directory(guild_id), f"{user_id}.txt")
+
+    def get_clue_index_file(self, guild_id):
+        return os.path.join(self.get_server_directory(guild_id), "clue_index.json")
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    def ensure_guild(self, guild_id):
+        """Nothing to set up: guilds without clues of their own share the default set, and directories are
+        made when something is written."""
+
+    def guild_ids(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [int(name) for name in os.listdir(self.root) if name.isdigit()]
+
+    def load_settings(self, guild_id):
+        metrics.increment("bingo_file_reads_total")
+        try:
+            with open(self.get_settings_file(guild_id), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default_settings()
+
+    def save_settings(self, guild_id, settings):
+        settings_file = self.get_settings_file(guild_id)
+        os.makedirs(os.path.dirname(settings_file), exist_ok=True)
+        with atomic_write(settings_file) as f:
+            json.dump(settings, f, indent=4)
+
+    def read_clue_set(self, set_id):
+        metrics.increment("bingo_file_reads_total")
+        try:
+            with open(self.get_clue_set_file(set_id), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        return data["expansion"], data["clues"]
+
+    def write_clue_set(self, clue_set):
+        path = self.get_clue_set_file(clue_set.id)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as f:
+            json.dump({"expansion": clue_set.expansion, "clues": list(clue_set.clues)}, f, ensure_ascii=False)
+
+    def current_clue_set(self, guild_id):
+        """The guild's current ClueSet, moving a clues.txt of its own into the shared store on first use."""
+        set_id = self.guild_clue_sets.get(guild_id)
+        if set_id is None:
+            metrics.increment("bingo_file_reads_total")
+            try:
+                with open(self.get_clue_set_pointer_file(guild_id), "r") as f:
+                    set_id = f.read().strip()
+            except FileNotFoundError:
+                clues_file = self.get_clues_file(guild_id)
+                if os.path.exists(clues_file):
+                    self.save_clues(guild_id, *read_sheet(clues_file))
+                    os.remove(clues_file)
+                    return self.clue_sets.get(self.guild_clue_sets[guild_id])
+                set_id = self.clue_sets.default().id
+            self.guild_clue_sets[guild_id] = set_id
+        return self.clue_sets.get(set_id) or self.clue_sets.default()
+
+    def load_clues(self, guild_id):
+        """Return (expansion, clues) for the guild."""
+        clue_set = self.current_clue_set(guild_id)
+        return clue_set.expansion, list(clue_set.clues)
+
+    def save_clues(self, guild_id, expansion, clues):
+        clue_set = self.clue_sets.put(expansion, clues)
+        os.makedirs(self.get_server_directory(guild_id), exist_ok=True)
+        with atomic_write(self.get_clue_set_pointer_file(guild_id)) as f:
+            f.write(clue_set.id)
+        self.guild_clue_sets[guild_id] = clue_set.id
+
+    def user_ids(self, guild_id):
+        sheets_dir = self.get_bingo_sheets_directory(guild_id)
+        if not os.path.isdir(sheets_dir):
+            return []
+        names = {os.path.splitext(name)[0] for name in os.listdir(sheets_dir)}
+        return [int(name) for name in names if name.isdigit()]
+
+    def load_board(self, guild_id, user_id):
+        """Load a user's sheet, migrating it from the old ' X' text format if needed. Returns None if there is no sheet.
+
+        Sheets saved with their full clue texts are still read, and stored as clue set indices when next saved.
+        """
+        metrics.increment("bingo_file_reads_total")
+        try:
+            with open(self.get_sheet_file(guild_id, user_id), "r") as f:
+                data = json.load(f)
+            if "clue_set" in data:
+                return self.clue_sets.decode(
+                    data["clue_set"], data.get("cells"), data["crossed"], data.get("seed"), data.get("layout", 0))
+            return Board.from_dict(data)
+        except FileNotFoundError:
+            pass
+
+        legacy_file = self.get_legacy_sheet_file(guild_id, user_id)
+        if not os.path.exists(legacy_file):
+            return None
+        board = Board.from_legacy(*read_sheet(legacy_file))
+        self.write_board_file(guild_id, user_id, board)
+        os.remove(legacy_file)
+        # Saves that only cross cells don't touch the index, so add the sheet now. A missing index
+        # is built from every sheet when it is first read.
+        if os.path.exists(self.get_clue_index_file(guild_id)):
+            self.update_clue_index(guild_id, {user_id: board})
+        return board
+
+    def load_boards(self, guild_id, user_ids):
+        """Load several sheets as a {user_id: Board} dict, leaving out users without a sheet."""
+        boards = {user_id: self.load_board(guild_id, user_id) for user_id in user_ids}
+        return {user_id: board for user_id, board in boards.items() if board is not None}
+
+    def write_board_file(self, guild_id, user_id, board):
+        set_id, cells, seed, layout = self.clue_sets.encode(board, self.current_clue_set(guild_id))
+        data = {"clue_set": set_id, "cells": cells} if seed is None else {"clue_set": set_id, "seed": seed, "layout": layout}
+        data["crossed"] = board.crossed
+        os.makedirs(self.get_bingo_sheets_directory(guild_id), exist_ok=True)
+        with atomic_write(self.get_sheet_file(guild_id, user_id)) as f:
+            json.dump(data, f, separators=(",", ":"))
+
+    def save_board(self, guild_id, user_id, board):
+        self.save_boards(guild_id, {user_id: board})
+
+    def save_boards(self, guild_id, boards, reindex=True):
+        """Save many sheets at once from a {user_id: Board} dict and update the clue index once.
+
+        Pass reindex=False when only their crossed cells changed, to skip reading and rewriting the index.
+        """
+        for user_id, board in boards.items():
+            self.write_board_file(guild_id, user_id, board)
+        if reindex:
+            self.update_clue_index(guild_id, boards)
+
+    def delete_boards(self, guild_id, user_ids):
+        """Remove the sheets of user_ids and their clue index entries."""
+        user_keys = {str(user_id) for user_id in user_ids}
+        for user_id in user_ids:
+            for path in (self.get_sheet_file(guild_id, user_id), self.get_legacy_sheet_file(guild_id, user_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+        index = self.load_clue_index(guild_id)
+        for clue, users in list(index.items()):
+            for user_key in user_keys & users.keys():
+                del users[user_key]
+            if not users:
+                del index[clue]
+        self.save_clue_index(guild_id, index)
+
+    def load_clue_index(self, guild_id):
+        """The guild's inverted index as {clue: {user_id (str): cell index}}, built from the sheets if missing."""
+        metrics.increment("bingo_file_reads_total")
+        try:
+            with open(self.get_clue_index_file(guild_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        index = {}
+        for user_id in self.user_ids(guild_id):
+            board = self.load_board(guild_id, user_id)
+            if board is not None:
+                index_board(index, user_id, board)
+        self.save_clue_index(guild_id, index)
+        return index
+
+    def save_clue_index(self, guild_id, index):
+        os.makedirs(self.get_server_directory(guild_id), exist_ok=True)
+        with atomic_write(self.get_clue_index_file(guild_id)) as f:
+            json.dump(index, f)
+
+    def update_clue_index(self, guild_id, boards):
+        index = self.load_clue_index(guild_id)
+        changed = False
+        for user_id, board in boards.items():
+            changed |= index_board(index, user_id, board)
+        if changed:
+            self.save_clue_index(guild_id, index)
+
+    def clue_cells(self, guild_id, clue):
+        """Every sheet containing clue, as {user_id: cell index}."""
+        users = self.load_clue_index(guild_id).get(clue, {})
+        return {int(user_id): cell for user_id, cell in users.items()}
+
+    def update_crossed(self, guild_id, user_id, cross=0, uncross=0):
+        """Set the cells in cross and clear the cells in uncross (both bitmasks).
+
+        Returns (previous crossed mask, updated board), or None if the user has no sheet.
+        """
+        board = self.load_board(guild_id, user_id)
+        if board is None:
+            return None
+        previous = board.crossed
+        board.crossed = (previous | cross) & ~uncross
+        if board.crossed != previous:
+            # The clues didn't change, so the clue index stays as it is
+            self.write_board_file(guild_id, user_id, board)
+        return previous, board
+
+    def close(self):
+        pass
+
+
+def pack_cells(cells):
+    """Clue set indices as little-endian 16-bit integers, 50 bytes for a sheet."""
+    return struct.pack(f"<{len(cells)}h", *cells)
+
+
+def unpack_cells(data):
+    return list(struct.unpack(f"<{len(data) // 2}h", data))
+
+
+class SQLiteStorage:
+    """Keeps every guild in one SQLite database in WAL mode, with sheets indexed by (guild_id, user_id).
+
+    Sheets store a clue set ID and either the seed and layout they were generated from or their cells
+    as packed clue set indices. All queries are constant
+    parameterized SQL, so sqlite3 prepares each statement once and reuses it from its statement cache.
+    """
+
+    SHEETS_TABLE = """
+        CREATE TABLE IF NOT EXISTS sheets (
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            clue_set TEXT NOT NULL,
+            cells BLOB NOT NULL,
+            crossed INTEGER NOT NULL DEFAULT 0,
+            seed INTEGER,
+            layout INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, user_id)
+        )"""
+
+    SCHEMA = SHEETS_TABLE + """;
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY,
+            settings TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS clue_sets (
+            clue_set TEXT PRIMARY KEY,
+            expansion TEXT,
+            clues TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS guild_clue_sets (
+            guild_id INTEGER PRIMARY KEY,
+            clue_set TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS clue_cells (
+            guild_id INTEGER NOT NULL,
+            clue TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            cell INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, clue, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS clue_cells_by_user ON clue_cells (guild_id, user_id);
+    """
+
+    def __init__(self, path="bingo.db"):
+        self.path = path
+        # Shard worker processes share the database, so wait for each other's write locks
+        self.connection = sqlite3.connect(path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self.transaction_depth = 0
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.clue_sets = ClueSets(self.read_clue_set, self.write_clue_set)
+        self.guild_clue_sets = {}  # guild_id -> current clue set ID
+        self.connection.executescript(self.SCHEMA)
+        self.migrate_full_text_sheets()
+        self.add_seed_columns()
+
+    def migrate_full_text_sheets(self):
+        """Move a database from per-guild clue lists and full-text sheets to shared clue sets, once.
+
+        Sheets are re-saved through save_boards, which also rebuilds their clue index rows.
+        """
+        tables = {row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        sheet_columns = {row[1] for row in self.connection.execute("PRAGMA table_info(sheets)")}
+        if "clues" not in tables and "clues" not in sheet_columns:
+            return
+        with self.transaction():
+            if "clues" in tables:
+                for guild_id, expansion, clues in self.connection.execute(
+                        "SELECT guild_id, expansion, clues FROM clues").fetchall():
+                    self.save_clues(guild_id, expansion, json.loads(clues))
+                self.connection.execute("DROP TABLE clues")
+            if "clues" in sheet_columns:
+                self.connection.execute("ALTER TABLE sheets RENAME TO full_text_sheets")
+                self.connection.execute(self.SHEETS_TABLE)
+                boards = {}
+                for guild_id, user_id, expansion, clues, crossed in self.connection.execute(
+                        "SELECT guild_id, user_id, expansion, clues, crossed FROM full_text_sheets"):
+                    boards.setdefault(guild_id, {})[user_id] = Board(expansion, json.loads(clues), crossed)
+                for guild_id, guild_boards in boards.items():
+                    self.save_boards(guild_id, guild_boards)
+                self.connection.execute("DROP TABLE full_text_sheets")
+
+    def add_seed_columns(self):
+        """Add the seed and layout columns to a sheets table from before sheets were generated from seeds."""
+        sheet_columns = {row[1] for row in self.connection.execute("PRAGMA table_info(sheets)")}
+        if "seed" not in sheet_columns:
+            with self.transaction():
+                self.connection.execute("ALTER TABLE sheets ADD COLUMN seed INTEGER")
+                self.connection.execute("ALTER TABLE sheets ADD COLUMN layout INTEGER NOT NULL DEFAULT 0")
+
+    def transaction(self):
+        """Context manager running its block in one IMMEDIATE transaction. Transactions may be nested."""
+        return Transaction(self)
+
+    def ensure_guild(self, guild_id):
+        """Nothing to set up: guilds without clues of their own share the default set."""
+
+    def guild_ids(self):
+        rows = self.connection.execute(
+            "SELECT guild_id FROM guilds UNION SELECT guild_id FROM guild_clue_sets UNION SELECT guild_id FROM sheets")
+        return [row[0] for row in rows]
+
+    def load_settings(self, guild_id):
+        row = self.connection.execute("SELECT settings FROM guilds WHERE guild_id = ?", (guild_id,)).fetchone()
+        return json.loads(row[0]) if row else default_settings()
+
+    def save_settings(self, guild_id, settings):
+        self.connection.execute(
+            "INSERT INTO guilds (guild_id, settings) VALUES (?, ?) "
+            "ON CONFLICT (guild_id) DO UPDATE SET settings = excluded.settings",
+            (guild_id, json.dumps(settings)))
+
+    def read_clue_set(self, set_id):
+        row = self.connection.execute(
+            "SELECT expansion, clues FROM clue_sets WHERE clue_set = ?", (set_id,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def write_clue_set(self, clue_set):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO clue_sets (clue_set, expansion, clues) VALUES (?, ?, ?)",
+            (clue_set.id, clue_set.expansion, json.dumps(list(clue_set.clues))))
+
+    def current_clue_set(self, guild_id):
+        set_id = self.guild_clue_sets.get(guild_id)
+        if set_id is None:
+            row = self.connection.execute(
+                "SELECT clue_set FROM guild_clue_sets WHERE guild_id = ?", (guild_id,)).fetchone()
+            set_id = self.guild_clue_sets[guild_id] = row[0] if row else self.clue_sets.default().id
+        return self.clue_sets.get(set_id) or self.clue_sets.default()
+
+    def load_clues(self, guild_id):
+        """Return (expansion, clues) for the guild."""
+        clue_set = self.current_clue_set(guild_id)
+        return clue_set.expansion, list(clue_set.clues)
+
+    def save_clues(self, guild_id, expansion, clues):
+        clue_set = self.clue_sets.put(expansion, clues)
+        self.connection.execute(
+            "INSERT INTO guild_clue_sets (guild_id, clue_set) VALUES (?, ?) "
+            "ON CONFLICT (guild_id) DO UPDATE SET clue_set = excluded.clue_set",
+            (guild_id, clue_set.id))
+        self.guild_clue_sets[guild_id] = clue_set.id
+
+    def user_ids(self, guild_id):
+        rows = self.connection.execute("SELECT user_id FROM sheets WHERE guild_id = ?", (guild_id,))
+        return [row[0] for row in rows]
+
+    def load_board(self, guild_id, user_id):
+        row = self.connection.execute(
+            "SELECT clue_set, cells, crossed, seed, layout FROM sheets WHERE guild_id = ? AND user_id = ?",
+            (guild_id, user_id)).fetchone()
+        return self.decode_board(*row) if row else None
+
+    SAVE_BOARD = (
+        "INSERT INTO sheets (guild_id, user_id, clue_set, cells, crossed, seed, layout) VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (guild_id, user_id) DO UPDATE SET clue_set = excluded.clue_set, cells = excluded.cells, "
+        "crossed = excluded.crossed, seed = excluded.seed, layout = excluded.layout")
+
+    def encode_board(self, guild_id, user_id, board, current):
+        """Row for SAVE_BOARD. Sheets generated from a seed store it with an empty cells blob."""
+        set_id, cells, seed, layout = self.clue_sets.encode(board, current)
+        return guild_id, user_id, set_id, pack_cells(cells or []), board.crossed, seed, layout
+
+    def decode_board(self, set_id, cells, crossed, seed, layout):
+        return self.clue_sets.decode(set_id, unpack_cells(cells), crossed, seed, layout)
+
+    def save_board(self, guild_id, user_id, board):
+        self.save_boards(guild_id, {user_id: board})
+
+    def save_boards(self, guild_id, boards, reindex=True):
+        """Save many sheets at once from a {user_id: Board} dict, in one transaction, and re-index their clues
+        unless reindex is False because only their crossed cells changed."""
+        with self.transaction():
+            current = self.current_clue_set(guild_id)
+            self.connection.executemany(self.SAVE_BOARD, [
+                self.encode_board(guild_id, user_id, board, current) for user_id, board in boards.items()])
+            if not reindex:
+                return
+            self.connection.executemany(
+                "DELETE FROM clue_cells WHERE guild_id = ? AND user_id = ?",
+                [(guild_id, user_id) for user_id in boards])
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO clue_cells (guild_id, clue, user_id, cell) VALUES (?, ?, ?, ?)",
+                [(guild_id, clue, user_id, cell)
+                 for user_id, board in boards.items() for cell, clue in enumerate(board.clues)])
+
+    def delete_boards(self, guild_id, user_ids):
+        """Remove the sheets of user_ids and their clue index rows."""
+        rows = [(guild_id, user_id) for user_id in user_ids]
+        with self.transaction():
+            self.connection.executemany("DELETE FROM sheets WHERE guild_id = ? AND user_id = ?", rows)
+            self.connection.executemany("DELETE FROM clue_cells WHERE guild_id = ? AND user_id = ?", rows)
+
+    def load_boards(self, guild_id, user_ids):
+        """Load several sheets as a {user_id: Board} dict, leaving out users without a sheet."""
+        user_ids = list(user_ids)
+        boards = {}
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            rows = self.connection.execute(
+                "SELECT user_id, clue_set, cells, crossed, seed, layout FROM sheets "
+                f"WHERE guild_id = ? AND user_id IN ({', '.join('?' * len(chunk))})",
+                (guild_id, *chunk))
+            for user_id, *row in rows:
+                boards[user_id] = self.decode_board(*row)
+        return boards
+
+    def clue_cells(self, guild_id, clue):
+        """Every sheet containing clue, as {user_id: cell index}."""
+        rows = self.connection.execute(
+            "SELECT user_id, cell FROM clue_cells WHERE guild_id = ? AND clue = ?", (guild_id, clue))
+        return dict(rows)
+
+    def update_crossed(self, guild_id, user_id, cross=0, uncross=0):
+        """Set the cells in cross and clear the cells in uncross (both bitmasks) in one transaction.
+
+        Returns (previous crossed mask, updated board), or None if the user has no sheet.
+        """
+        with self.transaction():
+            board = self.load_board(guild_id, user_id)
+            if board is None:
+                return None
+            previous = board.crossed
+            board.crossed = (previous | cross) & ~uncross
+            self.connection.execute(
+                "UPDATE sheets SET crossed = ? WHERE guild_id = ? AND user_id = ?",
+                (board.crossed, guild_id, user_id))
+        return previous, board
+
+    def close(self):
+        self.connection.close()
+
+
+class Transaction:
+    """Runs a block in one IMMEDIATE transaction; nested transactions join the outermost one."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __enter__(self):
+        if self.storage.transaction_depth == 0:
+            self.storage.connection.execute("BEGIN IMMEDIATE")
+        self.storage.transaction_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.storage.transaction_depth -= 1
+        if self.storage.transaction_depth == 0:
+            self.storage.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def import_directory_tree(target, root="servers"):
+    """Copy every guild under a servers/ directory tree into another storage backend.
+
+    Returns (guilds imported, sheets imported). Legacy .txt sheets are read through the same migration
+    as FileStorage.load_board, so they end up converted in the source tree as well.
+    """
+    source = FileStorage(root)
+    guild_count = sheet_count = 0
+    for guild_id in source.guild_ids():
+        boards = {}
+        for user_id in source.user_ids(guild_id):
+            board = source.load_board(guild_id, user_id)
+            if board is not None:
+                boards[user_id] = board
+        clue_set = source.current_clue_set(guild_id)
+
+        with target.transaction():
+            target.save_settings(guild_id, source.load_settings(guild_id))
+            # Guilds on the default clues keep sharing the target's default set
+            if clue_set.id != source.clue_sets.default().id:
+                target.save_clues(guild_id, clue_set.expansion, clue_set.clues)
+            target.save_boards(guild_id, boards)
+
+        guild_count += 1
+        sheet_count += len(boards)
+    return guild_count, sheet_count